@@ -1,7 +1,5 @@
 # python libraries
 from __future__ import annotations
-import math
-from io import BytesIO
 import random
 from typing import TYPE_CHECKING, Callable, Union, Coroutine
 from datetime import datetime
@@ -14,9 +12,12 @@ from disnake.ext import commands
 from poll import add_poll_functionality
 
 # project files
-from responders import add_responses, MessageResponder
+from responders import add_responses, MessageResponder, ResponderIndex
+from executor import ResponderExecutor
+from caching import avatar_cache
 from scheduler import schedule_tasks
-from spellingbee import add_bee_functionality
+from spellingbee import add_bee_functionality, primary_session
+from db.database import flush_all
 
 # from letterboxed import add_letterboxed_functionality
 
@@ -31,7 +32,8 @@ class MitchBot(commands.InteractionBot):
         )
         self.last_disconnect: float = 0
         # set in on_ready:
-        self.responses: list[MessageResponder] = []
+        self.responses = ResponderIndex()
+        self.executor = ResponderExecutor()
         self.initialized = False
         self.test_mode: Union[bool, str] = "unknown"
         self.command_guild_ids: list[int] = []
@@ -45,12 +47,10 @@ class MitchBot(commands.InteractionBot):
         self.hint_functions[channel_id] = function
 
     @classmethod
-    async def get_avatar_small(cls, user: discord.User, final_size: int):
-        ceil_size = 2 ** (math.ceil(math.log(final_size, 2)))
-        ceil_size_avatar = user.display_avatar.replace(size=ceil_size, format="png")
-        return Image.open(BytesIO(await ceil_size_avatar.read())).resize(
-            (final_size, final_size), Image.LANCZOS
-        )
+    async def get_avatar_small(cls, user: discord.User, final_size: int) -> Image.Image:
+        """Returns a user's avatar resized to final_size x final_size. The image may
+        be shared with other callers, so it should be copied before being drawn on."""
+        return await avatar_cache.get(user, final_size)
 
     async def on_ready(self):
         print(f"Logged on as {self.user}!")
@@ -77,17 +77,17 @@ class MitchBot(commands.InteractionBot):
         )
 
     def register_responder(self, responder: MessageResponder):
-        self.responses.append(responder)
+        self.responses.add(responder)
 
     async def on_message(self, message: discord.Message):
         print(f"Message from {message.author}: {message.content}")
         if message.author == self.user:
             return
 
-        responded = False
-        for response in self.responses:
-            if response.react_to(message):
-                responded = True
+        triggered = self.responses.match(message)
+        for response in triggered:
+            self.executor.submit(response, message)
+        responded = len(triggered) > 0
 
         if not responded and MessageResponder.mentions_bot(message):
             response = random.choice(
@@ -102,6 +102,13 @@ class MitchBot(commands.InteractionBot):
             )
             await message.reply(response + ", " + message.author.display_name + ".")
 
+    async def close(self):
+        # writes that are normally put off are made now, while it's certain that
+        # the process is still around to make them
+        primary_session.flush()
+        flush_all()
+        await super().close()
+
     async def on_disconnect(self):
         self.last_disconnect = datetime.now().timestamp()
         print(f"disconnected :( {datetime.now().isoformat()}")
@@ -0,0 +1,263 @@
+"""
+In-memory caches for things that are expensive to get again, like user avatars that
+have to be downloaded from Discord's CDN and resized and the images that get made out
+of them. Like everything else, this expects the CWD to be the root directory of the
+repository.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import OrderedDict
+import math
+import os
+from timeit import default_timer as timer
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+import disnake as discord
+from PIL import Image
+
+from rendering import render_pool, resize_avatar
+
+
+class LRUCache:
+    """
+    Maps keys to values, throwing out the least recently used values once the total
+    size of the values (as measured by the sizeof function) goes over max_size. If
+    ttl is given, values are also thrown out once they are that many seconds old.
+    """
+
+    def __init__(
+            self,
+            max_size: int,
+            sizeof: Callable[[Any], int] = len,
+            ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        # values are stored with their size and the time they were put in
+        self._items: OrderedDict[Hashable, tuple[Any, int, float]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._items:
+            self.misses += 1
+            return default
+        value, _, stored_at = self._items[key]
+        if self.ttl is not None and timer() - stored_at > self.ttl:
+            self.pop(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self.pop(key)
+        value_size = self.sizeof(value)
+        if value_size > self.max_size:
+            return
+        self._items[key] = (value, value_size, timer())
+        self.size += value_size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self._items.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._items:
+            return default
+        value, value_size, _ = self._items.pop(key)
+        self.size -= value_size
+        return value
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def image_size(image: Image.Image) -> int:
+    """Approximate number of bytes taken up by a decoded image."""
+    return image.width * image.height * len(image.getbands())
+
+
+def _save_png(image: Image.Image, path: str):
+    temp_path = path + ".tmp"
+    image.save(temp_path, format="png")
+    os.replace(temp_path, path)
+
+
+def _load_png(path: str) -> Image.Image:
+    with Image.open(path) as image:
+        image.load()
+        return image
+
+
+def _prune_directory(directory: str, max_files: int):
+    """Deletes the oldest PNG files in a directory once there are more than
+    max_files of them."""
+    files = [
+        os.path.join(directory, x) for x in os.listdir(directory) if x.endswith(".png")
+    ]
+    if len(files) <= max_files:
+        return
+    files.sort(key=os.path.getmtime)
+    for old_file in files[:len(files)-max_files]:
+        os.remove(old_file)
+
+
+class AvatarCache:
+    """
+    Keeps users' avatars around after they've been downloaded and resized, keyed by
+    user id, avatar hash, and size, so that a new avatar (which comes with a new
+    hash) is never mistaken for an old one. Decoded images are kept in memory up to
+    memory_budget bytes; resized PNGs are also written to disk_dir (if it isn't
+    None) so that they survive restarts. Concurrent requests for the same avatar
+    share one download. The returned images are shared and must not be modified.
+    """
+
+    def __init__(
+            self,
+            memory_budget: int = 32*1024*1024,
+            disk_dir: Optional[str] = "db/avatar_cache",
+            max_disk_files: int = 2000):
+        self.memory = LRUCache(memory_budget, image_size)
+        self.disk_dir = disk_dir
+        self.max_disk_files = max_disk_files
+        self.downloads = 0
+        self.disk_hits = 0
+        self._in_flight: dict[tuple[int, str, int], asyncio.Future] = {}
+
+    @staticmethod
+    def key_for(user: discord.User, final_size: int) -> tuple[int, str, int]:
+        return (user.id, user.display_avatar.key, final_size)
+
+    def _disk_path(self, key: tuple[int, str, int]) -> str:
+        return os.path.join(self.disk_dir, "{}-{}-{}.png".format(*key))
+
+    async def get(self, user: discord.User, final_size: int) -> Image.Image:
+        key = self.key_for(user, final_size)
+        cached = self.memory.get(key)
+        if cached is not None:
+            return cached
+        if key not in self._in_flight:
+            fetching = asyncio.create_task(self._fetch(user, key))
+            self._in_flight[key] = fetching
+            fetching.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shielded so that one requester giving up doesn't cancel the download for
+        # everyone else
+        return await asyncio.shield(self._in_flight[key])
+
+    async def _fetch(self, user: discord.User, key: tuple[int, str, int]) -> Image.Image:
+        final_size = key[2]
+        disk_path = self._disk_path(key) if self.disk_dir is not None else None
+        if disk_path is not None and os.path.exists(disk_path):
+            try:
+                avatar = await render_pool.run(_load_png, disk_path)
+                self.disk_hits += 1
+                self.memory.put(key, avatar)
+                return avatar
+            except OSError:
+                print("could not read cached avatar from", disk_path)
+        ceil_size = 2 ** (math.ceil(math.log(final_size, 2)))
+        ceil_size_avatar = user.display_avatar.replace(size=ceil_size, format="png")
+        self.downloads += 1
+        avatar = await render_pool.run(
+            resize_avatar, await ceil_size_avatar.read(), final_size
+        )
+        self.memory.put(key, avatar)
+        if disk_path is not None:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                await render_pool.run(_save_png, avatar, disk_path)
+                await render_pool.run(_prune_directory, self.disk_dir, self.max_disk_files)
+            except OSError:
+                print("could not write cached avatar to", disk_path)
+        return avatar
+
+    def stats(self) -> dict:
+        return {
+            "memory_items": len(self.memory),
+            "memory_bytes": self.memory.size,
+            "hit_rate": self.memory.hit_rate,
+            "disk_hits": self.disk_hits,
+            "downloads": self.downloads,
+        }
+
+
+avatar_cache = AvatarCache()
+
+
+class RenderCache:
+    """
+    Keeps the finished PNG files made by deterministic render functions like
+    render_fight and render_kiss. Renders are keyed by what went into them: the kind
+    of render, the id and avatar hash of each user involved, and any other inputs
+    that could change the output (like the versions of the template images). When a
+    user shows up with a new avatar hash, every render made with their old avatar is
+    thrown out right away instead of waiting to age out.
+    """
+
+    def __init__(self, max_bytes: int = 16*1024*1024, ttl: float = 6*60*60):
+        self.renders = LRUCache(max_bytes, len, ttl)
+        # the last avatar hash seen for each user id
+        self._avatar_hashes: dict[int, str] = {}
+        self.invalidations = 0
+
+    def _check_avatars(self, users: list[discord.User]):
+        for user in users:
+            avatar_hash = user.display_avatar.key
+            old_hash = self._avatar_hashes.get(user.id)
+            if old_hash is not None and old_hash != avatar_hash:
+                stale_avatar = (user.id, old_hash)
+                for key in self.renders.keys():
+                    if stale_avatar in key[1]:
+                        self.renders.pop(key)
+                        self.invalidations += 1
+            self._avatar_hashes[user.id] = avatar_hash
+
+    async def get_or_render(
+            self,
+            kind: str,
+            users: list[discord.User],
+            render: Callable[[], Awaitable[bytes]],
+            *inputs: Hashable) -> bytes:
+        """Returns the cached result of a render if there is one and otherwise
+        awaits render() and caches what it returns."""
+        self._check_avatars(users)
+        key = (kind, tuple((x.id, x.display_avatar.key) for x in users), inputs)
+        cached = self.renders.get(key)
+        if cached is not None:
+            return cached
+        result = await render()
+        self.renders.put(key, result)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "renders": len(self.renders),
+            "bytes": self.renders.size,
+            "hits": self.renders.hits,
+            "misses": self.renders.misses,
+            "hit_rate": self.renders.hit_rate,
+            "expirations": self.renders.expirations,
+            "evictions": self.renders.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+render_cache = RenderCache()
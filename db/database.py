@@ -0,0 +1,208 @@
+"""
+Shared access to the SQLite files in db/. Each file gets one long-lived Database
+object (see get_database) instead of each piece of code opening and closing its own
+connections. Databases are put in WAL mode so that reading doesn't wait on writing
+(except for reference files that are checked into the repo, which are left as-is);
+schemas are set up through migrations that run once per file; and writes are handed
+to a thread that belongs to the database so that commits (and the fsyncs that come
+with them) don't hold up the event loop. Like everything else, this expects the CWD
+to be the root directory of the repository.
+"""
+
+from __future__ import annotations
+import atexit
+from concurrent.futures import Future
+from contextlib import contextmanager
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+from timeit import default_timer as timer
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+from executor import LatencyCounter
+
+
+class Database:
+    """
+    Holds two connections to one SQLite file: one for reads, which are run right
+    away on the calling thread, and one for writes, which are run in order on a
+    dedicated writer thread. Reads don't see writes that are still queued up; call
+    flush() first if that matters. In-memory databases can't be shared between
+    connections, so for those, one connection does both jobs. Pass wal=False for
+    files that are checked in and only read, so that opening them doesn't change
+    them on disk.
+    """
+
+    def __init__(self, path: str, wal: bool = True):
+        self.path = path
+        self.wal = wal and path != ":memory:"
+        # autocommit mode so that transactions can be started explicitly
+        self.connection = self._connect()
+        self.lock = threading.RLock()
+        if path == ":memory:":
+            self.write_connection = self.connection
+            self.write_lock = self.lock
+        else:
+            self.write_connection = self._connect()
+            self.write_lock = threading.RLock()
+        self._jobs: queue.SimpleQueue[tuple[Callable[[], Any], Future]] = queue.SimpleQueue()
+        # created when the first write is queued
+        self._writer: Optional[threading.Thread] = None
+        self.writes = 0
+        self.failed_writes = 0
+        # time spent running each write, including the commit, and time spent
+        # between a write being queued and being finished
+        self.write_latency = LatencyCounter()
+        self.queued_write_latency = LatencyCounter()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        if self.wal:
+            connection.execute("pragma journal_mode=wal")
+            # in WAL mode, this is still safe against corruption; a power cut can
+            # only lose the last few commits
+            connection.execute("pragma synchronous=normal")
+        connection.execute("pragma busy_timeout=5000")
+        return connection
+
+    def migrate(
+            self,
+            name: str,
+            *steps: Union[str, Callable[[sqlite3.Connection], Any]]):
+        """Runs the given SQL statements (or functions that take the connection) in
+        one transaction unless a migration with this name has already been run on
+        this file. Runs synchronously, since later code usually depends on it."""
+        with self.transaction() as connection:
+            connection.execute("""create table if not exists schema_migrations
+            (name text primary key, applied_at real);""")
+            if connection.execute(
+                    "select 1 from schema_migrations where name=?", (name,)).fetchone():
+                return
+            for step in steps:
+                if isinstance(step, str):
+                    connection.execute(step)
+                else:
+                    step(connection)
+            connection.execute(
+                "insert into schema_migrations (name, applied_at) values (?, ?)",
+                (name, time.time()))
+
+    def query(self, sql: str, parameters: Iterable = ()) -> list[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def query_one(self, sql: str, parameters: Iterable = ()) -> Optional[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchone()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Runs a write transaction on the calling thread, for when the result is
+        needed right away. Waits for the writer thread to finish whatever it is
+        doing but not for the rest of the queue."""
+        with self.write_lock:
+            start = timer()
+            self.write_connection.execute("begin immediate")
+            try:
+                yield self.write_connection
+                self.write_connection.execute("commit")
+            except:
+                self.write_connection.execute("rollback")
+                self.failed_writes += 1
+                raise
+            self.writes += 1
+            self.write_latency.record(timer() - start)
+
+    def submit(self, function: Callable[[], Any]) -> Future:
+        """Runs a function on the writer thread after every write queued before
+        it."""
+        future = Future()
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_forever,
+                name=f"db-writer-{os.path.basename(self.path)}",
+                daemon=True)
+            self._writer.start()
+        self._jobs.put((function, future))
+        return future
+
+    def _write_forever(self):
+        while True:
+            function, future = self._jobs.get()
+            try:
+                future.set_result(function())
+            except BaseException as e:
+                print(f"write to {self.path} failed:")
+                traceback.print_exc()
+                future.set_exception(e)
+
+    def write_transaction(self, function: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Queues up a function that gets the write connection and runs inside a
+        transaction on the writer thread."""
+        queued_at = timer()
+
+        def run():
+            with self.transaction() as connection:
+                result = function(connection)
+            self.queued_write_latency.record(timer() - queued_at)
+            return result
+        return self.submit(run)
+
+    def write(self, sql: str, parameters: Iterable = ()) -> Future:
+        parameters = tuple(parameters)
+        return self.write_transaction(lambda c: c.execute(sql, parameters).rowcount)
+
+    def write_many(self, sql: str, parameters: Iterable[Iterable]) -> Future:
+        # materialized now, since whatever the parameters come from might change
+        # before the writer thread gets to them
+        parameters = [tuple(x) for x in parameters]
+        return self.write_transaction(lambda c: c.executemany(sql, parameters).rowcount)
+
+    def flush(self):
+        """Waits until every write queued so far has been run."""
+        if self._writer is None or threading.current_thread() is self._writer:
+            return
+        self.submit(lambda: None).result()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._jobs.qsize(),
+            "writes": self.writes,
+            "failed_writes": self.failed_writes,
+            "write_latency": self.write_latency,
+            "queued_write_latency": self.queued_write_latency,
+        }
+
+
+_databases: dict[str, Database] = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path: str, wal: bool = True) -> Database:
+    """Returns the Database for a file, opening it the first time it's asked
+    for. Every request for an in-memory database gets a new one, like it would
+    with sqlite3.connect. wal only matters the first time a file is opened."""
+    if path == ":memory:":
+        return Database(path)
+    key = os.path.realpath(path)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = Database(path, wal)
+        return _databases[key]
+
+
+def flush_all():
+    for database in list(_databases.values()):
+        database.flush()
+
+
+def database_stats() -> dict[str, dict]:
+    return {path: database.stats() for path, database in _databases.items()}
+
+
+# registered before anything that queues writes at exit, so this runs after them
+atexit.register(flush_all)
@@ -1,25 +1,47 @@
 """
 Provides functions to access the word frequency and wiktionary words databases (which
 are in SQLite and bespoke trie database forms, respectively) as well as the nicknames
-in db/nicknames.json and poetry from text/poetry.txt. The RandomNoRepeats class
+in db/nicknames.json and the poetry, strategies, and other text corpora in text/
+(which should only ever be read through the corpora defined here.) The RandomNoRepeats class
 defined here is also useful in general. Note: the paths within this file are
 constructed with the expectation that the CWD will be the root directory of the
 repository. Puzzles are persisted via code in the SpellingBee and Letterboxed classes
 (not here.)
 """
 
+import asyncio
+import atexit
 import json
+import os
+import re
 import sqlite3
-from typing import Any, Optional
+import sys
+from typing import Any, Callable, Optional, TextIO
 from timeit import default_timer as timer
 import random
-from typing import Sequence
+from typing import Iterable, Sequence
 from math import inf
 
 from timezonefinder import TimezoneFinder
 
+from db.database import Database, get_database
 
-words_db = sqlite3.connect("db/words.db")
+
+# words.db and cities.db are reference data that the bot only reads, so they're
+# opened without switching them to WAL mode
+words_db = get_database("db/words.db", wal=False)
+
+# optional copy of the whole words table in memory, filled in by
+# load_word_rank_index
+word_rank_index: Optional[dict[str, int]] = None
+
+
+def load_word_rank_index():
+    """Loads every word's rank into memory so that get_word_rank and get_word_ranks
+    stop querying words.db. This trades a chunk of memory for speed, so it's only
+    worth it for processes that look up lots of words."""
+    global word_rank_index
+    word_rank_index = dict(words_db.query("select word, rank from words"))
 
 
 def get_word_rank(word: str) -> int:
@@ -27,50 +49,257 @@ def get_word_rank(word: str) -> int:
     Exposes the word frequency data stored in words.db to easy python access. The
     lower the rank, the more common the word.
     """
-    cur = words_db.cursor()
-    rank = cur.execute(
+    if word_rank_index is not None:
+        return word_rank_index.get(word.lower(), inf)
+    rank = words_db.query_one(
         "select rank from words where word=?",
         (word.lower(),)
-    ).fetchone()
+    )
     return inf if rank is None else rank[0]
 
 
-cities_db = sqlite3.connect("db/cities.db")
+def get_word_ranks(words: Iterable[str]) -> dict[str, int]:
+    """
+    Like get_word_rank, but for lots of words at once; returns a dictionary mapping
+    each of the given words to its rank. Uses one query per 900 distinct words
+    (SQLite's limit on query parameters is 999.)
+    """
+    words = list(words)
+    lowered = {word.lower() for word in words}
+    if word_rank_index is not None:
+        ranks = {x: word_rank_index.get(x, inf) for x in lowered}
+    else:
+        ranks = dict.fromkeys(lowered, inf)
+        lowered = list(lowered)
+        for i in range(0, len(lowered), 900):
+            chunk = lowered[i:i+900]
+            ranks.update(words_db.query(
+                "select word, rank from words where word in " +
+                f"({','.join('?'*len(chunk))})",
+                chunk
+            ))
+    return {word: ranks[word.lower()] for word in words}
+
+
+cities_db = get_database("db/cities.db", wal=False)
+
+
+def _add_tz_column(connection: sqlite3.Connection):
+    if "tz" not in {x[1] for x in connection.execute("pragma table_info(location)")}:
+        connection.execute("alter table location add column tz text")
+
+
+# time zones are precomputed by backfill_city_timezones and stored alongside each
+# city in the checked-in file; a city without one gets it looked up (but not saved,
+# so that the file isn't changed) when it is chosen
+# the location table is never added to or deleted from, so this doesn't change
+max_city_rowid: int = cities_db.query_one("select max(rowid) from location")[0]
+
+_timezone_finder: Optional[TimezoneFinder] = None
+
+
+def get_timezone_finder() -> TimezoneFinder:
+    """Returns the TimezoneFinder shared by everything in this process, creating it
+    (which means loading a lot of polygon data) the first time it is needed."""
+    global _timezone_finder
+    if _timezone_finder is None:
+        _timezone_finder = TimezoneFinder()
+    return _timezone_finder
 
 
 def get_random_city_timezone() -> tuple[str, str]:
-    cur = cities_db.cursor()
-    random_city = cur.execute(
-        "select city, longitude, latitude from location " +
-        "order by random() limit 1").fetchone()
-    finder = TimezoneFinder()
-    zone = finder.timezone_at(lng=random_city[1], lat=random_city[2])
-    return (random_city[0], zone)
+    # picking a random rowid and taking the first city at or after it avoids having
+    # to sort the whole table by random()
+    random_city = cities_db.query_one(
+        "select rowid, city, longitude, latitude, tz from location " +
+        "where rowid >= ? order by rowid limit 1",
+        (random.randint(1, max_city_rowid),))
+    rowid, city, longitude, latitude, zone = random_city
+    if zone is None:
+        zone = get_timezone_finder().timezone_at(lng=longitude, lat=latitude)
+    return (city, zone)
+
+
+def backfill_city_timezones():
+    """Fills in the time zone of every city in db/cities.db that doesn't have one.
+    Run with `python -m db.queries backfill_timezones` and commit the result."""
+    with cities_db.transaction() as connection:
+        _add_tz_column(connection)
+    missing = cities_db.query(
+        "select rowid, longitude, latitude from location where tz is null")
+    finder = get_timezone_finder()
+    cities_db.write_many(
+        "update location set tz=? where rowid=?",
+        ((finder.timezone_at(lng=longitude, lat=latitude), rowid)
+         for rowid, longitude, latitude in missing)).result()
+    print(f"filled in time zones for {len(missing)} cities")
+
+
+class WatchedFile:
+    """
+    Parses a file once and keeps the result, parsing it again only when the file's
+    modification time or size changes, so that the file can be edited while the bot
+    is running without it having to be read on every access.
+    """
+
+    def __init__(self, path: str, parse: Callable[[TextIO], Any]):
+        self.path = path
+        self.parse = parse
+        self._stamp: Optional[tuple[float, int]] = None
+        self._value: Any = None
+
+    @property
+    def value(self) -> Any:
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime, stat.st_size)
+        if stamp != self._stamp:
+            with open(self.path, encoding="utf-8") as file:
+                self._value = self.parse(file)
+            self._stamp = stamp
+        return self._value
+
+
+class NicknameProvider:
+    """Serves random nicknames from db/nicknames.json, which is only parsed again
+    when it changes."""
+
+    def __init__(self, path: str = "db/nicknames.json"):
+        # the file has a few duplicates, which would otherwise show up twice as
+        # often and break sample's no_repeats promise
+        self.file = WatchedFile(path, lambda f: list(dict.fromkeys(json.load(f))))
+
+    def get(self) -> str:
+        return random.choice(self.file.value)
+
+    def sample(self, k: int, no_repeats: bool = True) -> list[str]:
+        """Returns k random nicknames. If no_repeats is True, no nickname is
+        repeated until every nickname has been used."""
+        nicknames: list[str] = self.file.value
+        if not no_repeats:
+            return random.choices(nicknames, k=k)
+        result = []
+        while len(result) < k:
+            result += random.sample(nicknames, min(k-len(result), len(nicknames)))
+        return result
+
+
+nicknames = NicknameProvider()
 
 
 def get_random_nickname() -> str:
-    with open("db/nicknames.json", encoding="utf-8") as nickname_file:
-        return random.choice(json.load(nickname_file))
+    return nicknames.get()
+
+
+class TextCorpus:
+    """
+    The records (lines, poems, words, etc.) in one of the files in text/. The file
+    is read and split into records the first time it is needed and again only when
+    it changes; after that, getting a record, random or otherwise, doesn't touch the
+    file.
+    """
+
+    def __init__(self, path: str, split: Callable[[str], list[str]]):
+        self.file = WatchedFile(path, lambda f: split(f.read()))
+
+    @property
+    def records(self) -> list[str]:
+        return self.file.value
+
+    def random(self) -> str:
+        return random.choice(self.records)
+
+    def __getitem__(self, index: int) -> str:
+        return self.records[index]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+def _split_lines(text: str) -> list[str]:
+    return [x.strip() for x in text.split("\n") if x.strip()]
+
+
+def _split_sections(text: str) -> list[str]:
+    return [x.strip() for x in text.split("\n---\n") if x.strip()]
+
+
+def _split_words(text: str) -> list[str]:
+    # words and "multi-word phrases" in quotes
+    return [
+        x.strip('"')
+        for x in re.findall(r"(?:\"[^\"]+?\")|(?:\b(?:\w|-)+?\b)", text)
+    ]
+
+
+corpora: dict[str, TextCorpus] = {
+    "poetry": TextCorpus("text/poetry.txt", _split_sections),
+    "prompts": TextCorpus("text/prompts.txt", _split_lines),
+    "strategies": TextCorpus("text/strategies.txt", _split_lines),
+    "untamed": TextCorpus("text/untamed.txt", _split_words),
+}
 
 
 def get_random_strategy() -> str:
-    with open("text/strategies.txt", encoding="utf-8") as strategy_file:
-        return random.choice(strategy_file.read().split("\n"))
+    return corpora["strategies"].random()
 
 
-def get_next_mail(mark_retrieved=True) -> Optional[str]:
-    with open("db/mail.json", encoding="utf-8", mode="r+") as mail_file:
-        mailbag = json.load(mail_file)
+class MailQueue:
+    """
+    Queue of mail to be sent out with the nightly poem. New mail is written into
+    db/mail.json (or passed to add()); whenever that file changes, any entries that
+    aren't in the queue yet are appended to the mail table in db/mail.db, and
+    entries that are already there are left alone. Taking the next piece of mail is
+    a single indexed lookup and update in one transaction, so it is atomic and safe
+    to do from multiple threads or processes at once.
+    """
+
+    def __init__(self, db_path: str = "db/mail.db", inbox_path: str = "db/mail.json"):
+        self.db = get_database(db_path)
+        self.db.migrate(
+            "mail",
+            "create table if not exists mail " +
+            "(id integer primary key, text text unique, retrieved integer)",
+            # only contains the mail that hasn't been sent out yet
+            "create index if not exists unretrieved on mail (id) where retrieved=0")
+        self.inbox = WatchedFile(inbox_path, json.load)
+        self._imported_inbox = None
+
+    def _import_inbox(self):
+        mailbag = self.inbox.value
+        if mailbag is self._imported_inbox:
+            return
         assert all("text" in x and "retrieved" in x for x in mailbag)
-        next_mail = next((x for x in mailbag if not x["retrieved"]), None)
-        if next_mail is not None:
-            if mark_retrieved:
-                next_mail["retrieved"] = True
-                mail_file.seek(0)
-                json.dump(mailbag, mail_file)
-                mail_file.truncate()
-            return next_mail["text"]
-        return None
+        self.add([x["text"] for x in mailbag], [x["retrieved"] for x in mailbag])
+        self._imported_inbox = mailbag
+
+    def add(self, texts: list[str], retrieved: Optional[list[bool]] = None):
+        """Appends mail to the end of the queue, skipping any that's already in it."""
+        if retrieved is None:
+            retrieved = [False]*len(texts)
+        with self.db.transaction() as connection:
+            connection.executemany(
+                "insert or ignore into mail (text, retrieved) values (?, ?)",
+                zip(texts, map(int, retrieved)))
+
+    def next(self, mark_retrieved: bool = True) -> Optional[str]:
+        self._import_inbox()
+        # done right away instead of on the writer thread, since the caller needs
+        # the result; it's one small transaction a day
+        with self.db.transaction() as connection:
+            next_mail = connection.execute(
+                "select id, text from mail where retrieved=0 order by id limit 1"
+            ).fetchone()
+            if next_mail is not None and mark_retrieved:
+                connection.execute(
+                    "update mail set retrieved=1 where id=?", (next_mail[0],))
+        return next_mail[1] if next_mail is not None else None
+
+
+mail_queue = MailQueue()
+
+
+def get_next_mail(mark_retrieved=True) -> Optional[str]:
+    return mail_queue.next(mark_retrieved)
 
 
 class RandomNoRepeats:
@@ -86,18 +315,26 @@ class RandomNoRepeats:
     never been returned before will always be prioritized over every item that has
     been returned before; instantiating a new named sequence without an item that it
     previously contained is equivalent to removing it from the sequence forever.
+
+    The state of each sequence is loaded from the database once and then kept in
+    memory, with items grouped into buckets by how many times they have been used,
+    so picking an item doesn't require any queries. Changes are handed to the
+    database's writer thread in batches: once per turn of the event loop if one is
+    running and immediately otherwise (and by flush(), which is also called at exit.)
     """
-    random_db = sqlite3.connect("db/random.db")
-    cursor = random_db.cursor()
+    random_db: Database = get_database("db/random.db")
+    # greatest last_access_id handed out so far across all named sequences; loaded
+    # from the database when the first sequence is created
+    last_access_id: Optional[int] = None
 
     @classmethod
     def get_new_access_id(cls):
-        """Returns the greatest integer currently saved in the random table as an
-        access id plus one."""
-        result = cls.cursor.execute(
-            "select last_access_id from random order by last_access_id desc limit 1"
-        ).fetchone()
-        return result[0]+1
+        """Returns the greatest access id that has been used so far plus one."""
+        if cls.last_access_id is None:
+            result = cls.random_db.query_one("select max(last_access_id) from random")
+            cls.last_access_id = result[0] if result[0] is not None else -1
+        cls.last_access_id += 1
+        return cls.last_access_id
 
     def __init__(self, source: Sequence, name: str):
         if len(source) < 2:
@@ -105,7 +342,6 @@ class RandomNoRepeats:
         self.source = list(source)
         self.name = name
 
-        cur = self.cursor
         # id is arbitrary; name is self.name; item is the string version of the item
         # passed to the constructor as source; and last_access_id stores a unique
         # integer that identifies the get_item call that most recently returned this
@@ -113,61 +349,91 @@ class RandomNoRepeats:
         # sure that get_item never returns the same item twice in a row, even when
         # all the items associated with the collection name have been accessed an
         # equal number of times.
-        cur.execute(
+        self.random_db.migrate(
+            "random",
             "create table if not exists random " +
             "(id integer primary key, name text, item text, " +
-            "uses integer, last_access_id int)")
-        cur.execute("create index if not exists uses_by_name " +
-                    "on random (name, uses, last_access_id)")
+            "uses integer, last_access_id int)",
+            "create index if not exists uses_by_name " +
+            "on random (name, uses, last_access_id)")
 
-        existing_items: set[str] = set(x[0] for x in cur.execute(
-            "select item from random where name=?",
-            (name,)).fetchall())
+        # another sequence with the same name might have changes on their way
+        self.random_db.flush()
+        existing_items: dict[str, tuple[int, int]] = {
+            x[0]: (x[1], x[2]) for x in self.random_db.query(
+                "select item, uses, last_access_id from random where name=?",
+                (name,))}
         # this may very well end up being a mapping of strings to themselves...
         self.item_lookup: dict[str, Any] = {str(x): x for x in source}
 
-        for string in self.item_lookup.keys():
-            if string not in existing_items:
-                cur.execute(
-                    "insert into random (name, item, uses, last_access_id) values (?, ?, ?, ?)",
-                    (name, string, 0, -1)
-                )
-        for string in existing_items:
-            if string not in self.item_lookup:
-                cur.execute("delete from random where name=? and item=?",
-                            (name, string)
-                            )
+        self.random_db.write_many(
+            "insert into random (name, item, uses, last_access_id) values (?, ?, ?, ?)",
+            ((name, string, 0, -1) for string in self.item_lookup
+             if string not in existing_items))
+        self.random_db.write_many(
+            "delete from random where name=? and item=?",
+            ((name, string) for string in existing_items
+             if string not in self.item_lookup))
+
+        # maps numbers of uses to lists of the items that have been used that many
+        # times, along with each item's position in its list, so that items can be
+        # moved between buckets in constant time
+        self.buckets: dict[int, list[str]] = {}
+        self.uses: dict[str, int] = {}
+        self.positions: dict[str, int] = {}
+        # the item most recently returned, which can't be returned next
+        self.last_item: Optional[str] = None
+        greatest_access_id = -1
+        for string in self.item_lookup:
+            uses, last_access_id = existing_items.get(string, (0, -1))
+            self._add_to_bucket(string, uses)
+            if last_access_id > greatest_access_id:
+                greatest_access_id = last_access_id
+                self.last_item = string
 
-        self.random_db.commit()
+        # item -> (uses, last_access_id) for changes that haven't been written yet
+        self.pending: dict[str, tuple[int, int]] = {}
+        self.flush_scheduled = False
+        atexit.register(self.flush)
+
+    def _add_to_bucket(self, item: str, uses: int):
+        bucket = self.buckets.setdefault(uses, [])
+        self.positions[item] = len(bucket)
+        bucket.append(item)
+        self.uses[item] = uses
+
+    def _remove_from_bucket(self, item: str):
+        uses = self.uses[item]
+        bucket = self.buckets[uses]
+        position = self.positions[item]
+        # move the last item in the bucket into the removed item's spot
+        moved = bucket.pop()
+        if moved != item:
+            bucket[position] = moved
+            self.positions[moved] = position
+        if not bucket:
+            del self.buckets[uses]
 
     def get_item(self):
         """Returns a random item that has been returned fewer times than or, when
         necessary, the same number of times as every other item. Never returns the
         same item twice in a row."""
-        # find the least and most number of times any element has been used and the
-        # id of the last access that retrieved an item with name==self.name from the
-        # table
-        least_uses = self.cursor.execute(
-            "select uses from random where name=? " +
-            "order by uses limit 1",
-            (self.name,)).fetchone()[0]
-        most_uses = self.cursor.execute(
-            "select uses from random where name=? " +
-            "order by uses desc limit 1",
-            (self.name,)).fetchone()[0]
-        last_access = self.cursor.execute(
-            "select last_access_id from random where name=? " +
-            "order by last_access_id desc limit 1",
-            (self.name,)).fetchone()[0]
+        least_uses = min(self.buckets)
+        most_uses = max(self.buckets)
+        candidates = self.buckets[least_uses]
         # select a random element that has been used the least number of times any
-        # element has been used AND wasn't the last element to be accessed among
-        # those with name==self.name (as determined by the greatest last_access_id).
-        # if the greatest last_access_id is -1, it means that no items in this named
-        # category have ever been accessed, so we can ignore this condition.
-        item = self.cursor.execute(
-            "select item from random where name=? and uses=? and " +
-            "(last_access_id=-1 or last_access_id!=?) order by random() limit 1",
-            (self.name, least_uses, last_access)).fetchone()[0]
+        # element has been used AND wasn't the last element to be returned. the
+        # last element is skipped by choosing from one fewer positions and stepping
+        # over its position.
+        if (self.last_item is not None and len(candidates) > 1 and
+                self.uses[self.last_item] == least_uses):
+            skipped = self.positions[self.last_item]
+            position = random.randrange(len(candidates)-1)
+            if position >= skipped:
+                position += 1
+        else:
+            position = random.randrange(len(candidates))
+        item = candidates[position]
         # set the uses count of the item that was just used to the greatest number of
         # uses of any item in that named group, unless all the numbers of uses are
         # equal, in which case we need to increment from the current greatest number
@@ -179,25 +445,51 @@ class RandomNoRepeats:
         new_uses = most_uses
         if most_uses == least_uses:
             new_uses += 1
-        self.cursor.execute(
-            "update random set uses=?, last_access_id=? where item=?",
-            (new_uses, self.get_new_access_id(), item)
-        )
-        self.random_db.commit()
+        self._remove_from_bucket(item)
+        self._add_to_bucket(item, new_uses)
+        self.last_item = item
+        self.pending[item] = (new_uses, self.get_new_access_id())
+        self._schedule_flush()
         return self.item_lookup[item]
 
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            loop.call_soon(self.flush)
+
+    def flush(self):
+        """Writes any changes that haven't been saved yet to the database."""
+        self.flush_scheduled = False
+        if not self.pending:
+            return
+        self.random_db.write_many(
+            "update random set uses=?, last_access_id=? where name=? and item=?",
+            ((uses, access_id, self.name, item)
+             for item, (uses, access_id) in self.pending.items()))
+        self.pending.clear()
+
 
-with open("text/poetry.txt", encoding="utf-8") as poetry_file:
-    raw_poems = poetry_file.read().split("\n---\n")
-poetry = [p.strip() for p in raw_poems if p.strip()]
+poetry = corpora["poetry"].records
 poetry_source = RandomNoRepeats(poetry, "poetry")
 
 
 def get_random_poem() -> str:
+    global poetry, poetry_source
+    if corpora["poetry"].records is not poetry:
+        # the file has changed since the sequence was set up
+        poetry = corpora["poetry"].records
+        poetry_source = RandomNoRepeats(poetry, "poetry")
     return poetry_source.get_item()
 
 
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:] == ["backfill_timezones"]:
+    backfill_city_timezones()
+elif __name__ == "__main__":
     print("random city and timezone:", get_random_city_timezone())
     print()
     print("some words ordered by frequency:")
@@ -205,11 +497,15 @@ if __name__ == "__main__":
         sorted(
             ["especially", "when", "dogs", "should", "vote"],
             key=get_word_rank))
+    test_words = ["especially", "when", "dogs", "should", "vote", "xqzvw"]
+    assert get_word_ranks(test_words) == {x: get_word_rank(x) for x in test_words}
     print()
     print("random nickname:", get_random_nickname())
+    some_nicknames = nicknames.sample(25)
+    assert len(set(some_nicknames)) == 25, "no repeated nicknames"
     print()
-    RandomNoRepeats.random_db = sqlite3.connect(":memory:")
-    RandomNoRepeats.cursor = RandomNoRepeats.random_db.cursor()
+    RandomNoRepeats.random_db = get_database(":memory:")
+    RandomNoRepeats.last_access_id = None
     print("10 outputs from RandomNoRepeats coin flips:")
     flipper = RandomNoRepeats(["heads", "tails"], "coins")
     test_flips = [flipper.get_item() for _ in range(10)]
@@ -228,6 +524,19 @@ if __name__ == "__main__":
         assert subsequence[1] != subsequence[2], "no same result twice in a row"
         for element in ("heads", "tails", "not heads"):
             assert element in subsequence, "subsequence draws from all available elements equally"
+    other_flipper = RandomNoRepeats(["heads", "tails"], "other coins")
+    other_flipper.get_item()
+    reloaded_flipper = RandomNoRepeats(["heads", "tails", "not heads"], "coins")
+    assert reloaded_flipper.uses == new_flipper.uses, "state is saved per name"
+    assert reloaded_flipper.last_item == new_flipper.last_item, "last item is saved"
     print("next item in mailbag:")
     print(get_next_mail(False))
+    test_mail = MailQueue(":memory:")
+    unretrieved = [x["text"] for x in test_mail.inbox.value if not x["retrieved"]]
+    assert test_mail.next(False) == (unretrieved[0] if unretrieved else None)
+    test_mail.add(["first", "second"])
+    test_mail.add(["second", "third"])
+    assert [test_mail.next() for _ in range(len(unretrieved)+4)] == (
+        unretrieved + ["first", "second", "third", None]
+    ), "mail comes out in order without duplicates"
     print("tests passed")
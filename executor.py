@@ -0,0 +1,221 @@
+"""
+Runs the functions of triggered MessageResponders in the background without
+letting a flood of messages turn into an unbounded pile of tasks. Each channel gets
+its own queue that is worked through in order, each responder has a limit on how
+many copies of it can be running at once, and each responder decides what happens
+to new work when its channel's queue is full.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import deque
+from enum import Enum
+from timeit import default_timer as timer
+import traceback
+from typing import TYPE_CHECKING, Optional
+
+import disnake as discord
+
+if TYPE_CHECKING:
+    from responders import MessageResponder
+
+
+class OverloadPolicy(Enum):
+    # ignore new messages while the channel's queue is full
+    drop_newest = "drop_newest"
+    # throw out the message that has been waiting the longest to make room
+    drop_oldest = "drop_oldest"
+    # while the channel's queue is full, if the responder already has a message
+    # waiting from the same author with the same mentions (so the same request),
+    # respond to the new message instead of that one; otherwise, act like
+    # drop_newest
+    coalesce = "coalesce"
+
+
+class LatencyCounter:
+    """Keeps track of how many times something took place and how long it took."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return (f"<LatencyCounter count={self.count} average={self.average:.4f} "
+                f"max={self.max:.4f}>")
+
+
+class _Job:
+    def __init__(self, responder: MessageResponder, message: discord.Message):
+        self.responder = responder
+        self.message = message
+        self.enqueued_at = timer()
+
+
+class _ChannelQueue:
+    def __init__(self):
+        self.jobs: deque[_Job] = deque()
+        self.worker: Optional[asyncio.Task] = None
+
+
+class ResponderExecutor:
+    """
+    Accepts (responder, message) pairs from MitchBot.on_message and runs them. Each
+    channel's queue is worked through in order, except that jobs whose responder is
+    at its concurrency limit are skipped over (and wait their turn) without holding
+    up the jobs for other responders behind them; the limits are what keep a burst
+    of slow responses from spawning unbounded tasks. If a responder has a
+    busy_reply, messages that are dropped for it are answered with that. Queue
+    depths and latency counters are available through stats().
+    """
+
+    def __init__(self, max_queue_per_channel: int = 25):
+        self.max_queue_per_channel = max_queue_per_channel
+        self.channels: dict[int, _ChannelQueue] = {}
+        self.semaphores: dict[MessageResponder, asyncio.Semaphore] = {}
+        # strong references to running tasks so that they aren't garbage collected
+        self.running: set[asyncio.Task] = set()
+        # set (and replaced) whenever a job finishes and frees up its responder, or
+        # a new job is queued behind a blocked one
+        self._released = asyncio.Event()
+
+        self.submitted = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        # time spent in a channel queue before starting, and time spent running
+        self.wait_latency = LatencyCounter()
+        self.run_latency: dict[str, LatencyCounter] = {}
+
+    def submit(self, responder: MessageResponder, message: discord.Message) -> bool:
+        """Queues up a responder to respond to a message. Returns False if the work
+        was dropped because the channel's queue is full."""
+        self.submitted += 1
+        queue = self.channels.setdefault(message.channel.id, _ChannelQueue())
+        if len(queue.jobs) >= self.max_queue_per_channel:
+            if responder.overload == OverloadPolicy.drop_oldest:
+                queue.jobs.popleft()
+                self.dropped += 1
+            else:
+                if responder.overload == OverloadPolicy.coalesce:
+                    key = self._request_key(message)
+                    waiting = next(
+                        (x for x in queue.jobs if x.responder is responder
+                         and self._request_key(x.message) == key), None)
+                    if waiting is not None:
+                        waiting.message = message
+                        self.coalesced += 1
+                        return True
+                self.dropped += 1
+                self._tell_busy(responder, message)
+                return False
+        queue.jobs.append(_Job(responder, message))
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self._work(message.channel.id, queue))
+        else:
+            # the worker might be waiting because every other job is blocked, and
+            # this one might not be
+            self._wake()
+        return True
+
+    def _wake(self):
+        """Lets every worker that is waiting for a job to become runnable look
+        again."""
+        self._released.set()
+        self._released = asyncio.Event()
+
+    def _semaphore_for(self, responder: MessageResponder) -> asyncio.Semaphore:
+        if responder not in self.semaphores:
+            self.semaphores[responder] = asyncio.Semaphore(responder.max_concurrency)
+        return self.semaphores[responder]
+
+    @staticmethod
+    def _request_key(message: discord.Message) -> tuple:
+        return (message.author.id, tuple(sorted(x.id for x in message.mentions)))
+
+    def _tell_busy(self, responder: MessageResponder, message: discord.Message):
+        if responder.busy_reply is None:
+            return
+
+        async def reply():
+            try:
+                await message.reply(responder.busy_reply)
+            except Exception:
+                print("could not tell someone that the bot is busy:")
+                traceback.print_exc()
+        task = asyncio.create_task(reply())
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _work(self, channel_id: int, queue: _ChannelQueue):
+        try:
+            while queue.jobs:
+                # the first job whose responder isn't at its concurrency limit
+                job = next(
+                    (x for x in queue.jobs
+                     if not self._semaphore_for(x.responder).locked()), None)
+                if job is None:
+                    await self._released.wait()
+                    continue
+                queue.jobs.remove(job)
+                semaphore = self._semaphore_for(job.responder)
+                # doesn't wait, since the semaphore isn't locked
+                await semaphore.acquire()
+                self.wait_latency.record(timer() - job.enqueued_at)
+                task = asyncio.create_task(self._run(job, semaphore))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+        finally:
+            queue.worker = None
+            if not queue.jobs and self.channels.get(channel_id) is queue:
+                del self.channels[channel_id]
+
+    async def _run(self, job: _Job, semaphore: asyncio.Semaphore):
+        start = timer()
+        try:
+            await job.responder.run(job.message)
+            self.completed += 1
+        except Exception:
+            self.failed += 1
+            print(f"responder {job.responder.name} failed:")
+            traceback.print_exc()
+        finally:
+            semaphore.release()
+            self._wake()
+            self.run_latency.setdefault(
+                job.responder.name, LatencyCounter()
+            ).record(timer() - start)
+
+    def queue_depth(self, channel_id: Optional[int] = None) -> int:
+        """Returns the number of jobs waiting to start in a channel, or in all
+        channels if channel_id is None."""
+        if channel_id is not None:
+            queue = self.channels.get(channel_id)
+            return len(queue.jobs) if queue is not None else 0
+        return sum(len(x.jobs) for x in self.channels.values())
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "busiest_channels": sorted(
+                ((channel_id, len(x.jobs)) for channel_id, x in self.channels.items()),
+                key=lambda x: x[1], reverse=True)[:5],
+            "running": len(self.running),
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_latency": self.wait_latency,
+            "run_latency": dict(self.run_latency),
+        }
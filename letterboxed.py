@@ -1,15 +1,17 @@
 from __future__ import annotations
 import asyncio
-from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
 from difflib import SequenceMatcher
-from enum import Enum
+from array import array
 import json
+import multiprocessing
+import os
 from os import PathLike
 import re
 from io import BytesIO
 import sqlite3
 from timeit import default_timer
-from typing import Optional, Union, TYPE_CHECKING
+from typing import Iterable, Optional, TYPE_CHECKING
 from datetime import time, datetime, timedelta
 import traceback
 
@@ -21,8 +23,12 @@ from PIL import Image
 from bs4 import BeautifulSoup as Soup
 
 from responders import MessageResponder
+from reactions import reaction_scheduler
+from caching import LRUCache
+from letterboxed_solver import Direction, LetterBoxedSolver, shard_starts, solve_shard
 from scheduler import repeatedly_schedule_task_for, et
-from db.queries import get_word_rank
+from db.database import Database, get_database
+from db.queries import get_word_rank, get_word_ranks
 from grammar import andify, num, add_s, copula
 if TYPE_CHECKING:
     from MitchBot import MitchBot
@@ -36,6 +42,20 @@ with open(
     wiktionary = set(map(lambda x: x.casefold().strip(), wiktionary_file))
 
 
+# memoized results of LetterBoxedWord.is_common, keyed by upper-case word; capped,
+# since words from every day's puzzle end up in here
+common_words = LRUCache(50_000, lambda _: 1)
+
+
+def find_common_words(words: Iterable[str]):
+    """Looks up the ranks of all the given words that haven't been seen before in
+    one batch and memoizes whether they are common."""
+    new_words = [x.upper() for x in words if x.upper() not in common_words]
+    if new_words:
+        for word, rank in get_word_ranks(new_words).items():
+            common_words.put(word, rank < 100_000)
+
+
 class LetterBoxedWord:
     def __init__(self, word: str):
         self.word = word.upper()
@@ -54,7 +74,11 @@ class LetterBoxedWord:
 
     @property
     def is_common(self):
-        return get_word_rank(self.word) < 100_000
+        common = common_words.get(self.word)
+        if common is None:
+            common = get_word_rank(self.word) < 100_000
+            common_words.put(self.word, common)
+        return common
 
     def __eq__(self, other):
         return self.word == other.word
@@ -73,11 +97,10 @@ class LetterBoxedWord:
 
 
 class LetterBoxedSolution:
-    def __init__(self, initial: list[LetterBoxedWord | str] = []):
-        for i in range (len(initial)):
-            if type(initial[i]) is str:
-                initial[i] = LetterBoxedWord(initial[i])
-        self.words = initial
+    def __init__(self, initial: Optional[list[LetterBoxedWord | str]] = None):
+        self.words: list[LetterBoxedWord] = [
+            LetterBoxedWord(x) if type(x) is str else x for x in (initial or [])
+        ]
 
     def add_word(self, word: LetterBoxedWord):
         self.words.append(word)
@@ -91,6 +114,9 @@ class LetterBoxedSolution:
     def __hash__(self):
         return hash(tuple(self.words))
 
+    def __eq__(self, other):
+        return isinstance(other, LetterBoxedSolution) and self.words == other.words
+
     def __str__(self):
         return "->".join(str(x) for x in self.words)
 
@@ -120,12 +146,21 @@ class LetterBoxedSolution:
 
 
 class LetterBoxedSolutionSet:
-    def __init__(self, solutions: list[LetterBoxedSolution] = []):
-        self.solutions: set[LetterBoxedSolution] = set(solutions)
+    """
+    A set of solutions that keeps track of which words they use, which of those
+    words are common, and which solutions use only common words as solutions are
+    added, so those can be read at any time without going over every solution again.
+    """
+
+    def __init__(self, solutions: Optional[Iterable[LetterBoxedSolution]] = None):
+        self.solutions: set[LetterBoxedSolution] = set()
         self._words: set[LetterBoxedWord] = set()
         self._common_words: set[LetterBoxedWord] = set()
-        self._common_word_solutions: set[LetterBoxedWord] = set()
-        self.finalized = False
+        self._common_word_solutions: set[LetterBoxedSolution] = set()
+        # the aggregates are always up to date; this is kept for older callers
+        self.finalized = True
+        if solutions is not None:
+            self.update(solutions)
 
     def to_lists(self) -> list[list[str]]:
         solutions = []
@@ -135,52 +170,77 @@ class LetterBoxedSolutionSet:
 
     @classmethod
     def from_lists(cls, lists: list[list[str]]) -> LetterBoxedSolutionSet:
-        solutions = set()
-        for list in lists:
-            solutions.add(
-                LetterBoxedSolution([LetterBoxedWord(x) for x in list])
-            )
-        return cls(solutions)
+        return cls(
+            LetterBoxedSolution([LetterBoxedWord(x) for x in list]) for list in lists
+        )
 
-    def finalize(self):
-        for solution in self.solutions:
-            common = True
-            for word in solution.words:
-                self._words.add(word)
-                if word.is_common:
-                    self._common_words.add(word)
-                else:
+    def add(self, solution: LetterBoxedSolution):
+        if solution in self.solutions:
+            return
+        self.solutions.add(solution)
+        common = True
+        for word in solution.words:
+            if word in self._words:
+                if word not in self._common_words:
                     common = False
-            if common:
-                self._common_word_solutions.add(solution)
+                continue
+            self._words.add(word)
+            if word.is_common:
+                self._common_words.add(word)
+            else:
+                common = False
+        if common:
+            self._common_word_solutions.add(solution)
+
+    def update(self, solutions: Iterable[LetterBoxedSolution] | LetterBoxedSolutionSet):
+        """Adds solutions to this set in place. Merging in another set only looks
+        at the solutions that aren't already in this one."""
+        if isinstance(solutions, LetterBoxedSolutionSet):
+            for solution in solutions.solutions - self.solutions:
+                self.solutions.add(solution)
+                if solution in solutions._common_word_solutions:
+                    self._common_word_solutions.add(solution)
+            self._words |= solutions._words
+            self._common_words |= solutions._common_words
+        else:
+            for solution in solutions:
+                self.add(solution)
+
+    def finalize(self):
+        """Does nothing, since the aggregates are kept up to date as solutions are
+        added."""
         self.finalized = True
 
     @property
     def words(self):
-        if not self.finalized:
-            self.finalize()
         return self._words
 
     @property
     def common_words(self):
-        if not self.finalized:
-            self.finalize()
         return self._common_words
 
     @property
     def common_word_solutions(self):
-        if not self.finalized:
-            self.finalize()
         return self._common_word_solutions
 
-    def __add__(
+    def __iadd__(
         self,
         other: LetterBoxedSolutionSet | LetterBoxedSolution
     ) -> LetterBoxedSolutionSet:
         if isinstance(other, LetterBoxedSolutionSet):
-            return LetterBoxedSolutionSet(self.solutions.union(other.solutions))
+            self.update(other)
         else:
-            return LetterBoxedSolutionSet(self.solutions.union(set([other])))
+            self.add(other)
+        return self
+
+    def __add__(
+        self,
+        other: LetterBoxedSolutionSet | LetterBoxedSolution
+    ) -> LetterBoxedSolutionSet:
+        result = LetterBoxedSolutionSet()
+        result.update(self)
+        result += other
+        return result
 
     def __len__(self):
         return len(self.solutions)
@@ -188,10 +248,6 @@ class LetterBoxedSolutionSet:
     def __str__(self):
         return "{"+", ".join(str(x) for x in self.solutions)+"}"
 
-class Direction(Enum):
-    left="left"
-    right="right"
-
 class LetterBoxed:
     def __init__(
             self,
@@ -204,22 +260,29 @@ class LetterBoxed:
         self.timestamp = loaded_timestamp
 
         self.valid_words: set[LetterBoxedWord] = set()
-        self.min_word_score: int = 10000000  # good enough (max possible score is currently 12)
-        self.max_word_score: int = 0
         self.restricted_valid_words: set[LetterBoxedWord] = set()
-        self.index = {l: defaultdict(set) for l in alphabet}
-        self.reverse_index = {l: defaultdict(set) for l in alphabet}
 
+        find_common_words(valid_words)
         for word in map(LetterBoxedWord, valid_words):
             self.valid_words.add(word)
             if word.is_common:
                 self.restricted_valid_words.add(word)
-            self.min_word_score = min(word.unique_letters, self.min_word_score)
-            self.max_word_score = max(word.unique_letters, self.max_word_score)
-            self.index[word.first_letter][word.unique_letters].add(word)
-            self.reverse_index[word.last_letter][word.unique_letters].add(word)
+
+        # sorted so that word ids are the same every time the puzzle is loaded
+        self.word_list = sorted(x.word for x in self.valid_words)
+        self.word_ids = {x: i for i, x in enumerate(self.word_list)}
+        self.solver = LetterBoxedSolver(sides, self.word_list)
+        self.solver_words = [LetterBoxedWord(x) for x in self.solver.words]
 
         self.found_solution_sets: dict[int, LetterBoxedSolutionSet] = {}
+        # for each word, the lengths of the solutions it is part of, and the lengths
+        # of the solutions made entirely of common words that it is part of
+        self.solution_lengths: dict[LetterBoxedWord, set[int]] = {}
+        self.common_solution_lengths: dict[LetterBoxedWord, set[int]] = {}
+        # seconds taken by each shard of the last parallel search for each length
+        self.shard_timings: dict[int, list[float]] = {}
+        # the task running find_solutions, once start_finding_solutions is called
+        self.solving: Optional[asyncio.Task] = None
 
         self.graphic = self.fill_letters_into_template()
 
@@ -229,55 +292,169 @@ class LetterBoxed:
         self.db_path: str = ""
 
     def persist(self, db_path="db/puzzles.db"):
+        self.get_connection(db_path)
         self.db_path = db_path
         self.save()
 
+    # files that get_connection has already run the migrations on
+    migrated_paths: set[str] = set()
+
     @classmethod
-    def get_connection(self, db_path: PathLike) -> Optional[sqlite3.Connection]:
-        """Connects to the database, ensures the letterboxed table exists with the
-        correct schema, and returns the connection."""
-        if db_path is None:
+    def get_connection(self, db_path: PathLike) -> Optional[Database]:
+        """Returns the shared Database for db_path after making sure that the
+        letterboxed tables exist with the correct schema (which is only checked the
+        first time for each file; after that, use get_database directly.)
+
+        Each puzzle's valid words are stored once in letterboxed_words with ids
+        (their positions in alphabetical order); everything else refers to words by
+        id. The solutions of each length are stored as one blob of packed 16-bit
+        word ids, length ids per solution. Words found by users and words given as
+        hints are rows that are only ever added. The letterboxed table holds puzzles
+        saved in the old format, where everything was a JSON column in one row."""
+        if not db_path:
             return None
-        db = sqlite3.connect(db_path)
-        cur = db.cursor()
-        cur.execute("""create table if not exists letterboxed
-        (timestamp integer primary key, par integer, side1 text, side2 text, side3 text,
-        side4 text, valid_words text, found_solutions text,
-        user_found_words text, hints_given text);""")
-        cur.execute("""create index if not exists chrono on letterboxed(timestamp);""")
-        db.commit()
+        db = get_database(db_path)
+        key = os.path.realpath(db_path)
+        if key in self.migrated_paths:
+            return db
+        db.migrate(
+            "letterboxed",
+            """create table if not exists letterboxed
+            (timestamp integer primary key, par integer, side1 text, side2 text,
+            side3 text, side4 text, valid_words text, found_solutions text,
+            user_found_words text, hints_given text);""",
+            """create index if not exists chrono on letterboxed(timestamp);""")
+        db.migrate(
+            "letterboxed-normalized",
+            """create table if not exists letterboxed_puzzles
+            (timestamp integer primary key, par integer, side1 text, side2 text,
+            side3 text, side4 text);""",
+            """create table if not exists letterboxed_words
+            (timestamp integer, id integer, word text, primary key (timestamp, id))
+            without rowid;""",
+            """create table if not exists letterboxed_solutions
+            (timestamp integer, length integer, word_ids blob,
+            primary key (timestamp, length)) without rowid;""",
+            """create table if not exists letterboxed_user_words
+            (timestamp integer, word_id integer, primary key (timestamp, word_id))
+            without rowid;""",
+            """create table if not exists letterboxed_hints
+            (timestamp integer, word_id integer, primary key (timestamp, word_id))
+            without rowid;""")
+        self.migrated_paths.add(key)
         return db
 
+    def pack_solutions(self, solutions: LetterBoxedSolutionSet) -> bytes:
+        return array(
+            "H", (self.word_ids[w.word] for x in solutions.solutions for w in x.words)
+        ).tobytes()
+
+    def unpack_solutions(self, length: int, packed: bytes) -> LetterBoxedSolutionSet:
+        ids = array("H")
+        ids.frombytes(packed)
+        words = [LetterBoxedWord(x) for x in self.word_list]
+        return LetterBoxedSolutionSet(
+            LetterBoxedSolution([words[x] for x in ids[i:i+length]])
+            for i in range(0, len(ids), length)
+        )
+
     def save(self):
-        db = self.get_connection(self.db_path)
-        if db is None:
+        """Writes out the whole puzzle. Use the save_ methods below for small
+        changes."""
+        if not self.db_path:
+            return
+        db = get_database(self.db_path)
+        timestamp = self.timestamp
+        puzzle = (timestamp, self.par, *["".join(x) for x in self.sides])
+        words = list(enumerate(self.word_list))
+        solutions = [
+            (length, self.pack_solutions(x)) for length, x in self.found_solution_sets.items()
+        ]
+        user_words = [self.word_ids[x.word] for x in self.user_found_words]
+        hints = [self.word_ids[x.word] for x in self.hints_given]
+
+        def write(connection: sqlite3.Connection):
+            connection.execute(
+                """insert or replace into letterboxed_puzzles
+                (timestamp, par, side1, side2, side3, side4) values (?, ?, ?, ?, ?, ?);""",
+                puzzle)
+            connection.execute(
+                "delete from letterboxed_words where timestamp=?;", (timestamp,))
+            connection.executemany(
+                "insert into letterboxed_words (timestamp, id, word) values (?, ?, ?);",
+                ((timestamp, *x) for x in words))
+            connection.executemany(
+                """insert or replace into letterboxed_solutions
+                (timestamp, length, word_ids) values (?, ?, ?);""",
+                ((timestamp, *x) for x in solutions))
+            for table, word_ids in (
+                    ("letterboxed_user_words", user_words), ("letterboxed_hints", hints)):
+                connection.executemany(
+                    f"insert or ignore into {table} (timestamp, word_id) values (?, ?);",
+                    ((timestamp, x) for x in word_ids))
+        db.write_transaction(write)
+
+    def save_solutions(self, length: int):
+        if not self.db_path:
+            return
+        db = get_database(self.db_path)
+        db.write(
+            """insert or replace into letterboxed_solutions
+            (timestamp, length, word_ids) values (?, ?, ?);""",
+            (self.timestamp, length, self.pack_solutions(self.found_solution_sets[length]))
+        )
+
+    def save_words(self, table: str, words: Iterable[LetterBoxedWord]):
+        """Adds rows to letterboxed_user_words or letterboxed_hints."""
+        if not self.db_path:
             return
-        cur = db.cursor()
-        cur.execute(
-            """insert or replace into letterboxed
-            (timestamp, par, side1, side2, side3, side4, valid_words,
-            found_solutions, user_found_words, hints_given)
-            values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""",
-            (self.timestamp, self.par, *["".join(x) for x in self.sides],
-             json.dumps([x.word for x in self.valid_words]),
-             json.dumps(
-                 {key: value.to_lists() for key, value in self.found_solution_sets.items()}
-            ), json.dumps([x.word for x in self.user_found_words]),
-                json.dumps([x.word for x in self.hints_given]))
+        db = get_database(self.db_path)
+        db.write_many(
+            f"insert or ignore into {table} (timestamp, word_id) values (?, ?);",
+            ((self.timestamp, self.word_ids[x.word]) for x in words)
         )
-        db.commit()
-        db.close()
 
     @classmethod
     def retrieve_last_saved(cls, db_path: str = "db/puzzles.db") -> Optional[LetterBoxed]:
         db = cls.get_connection(db_path)
-        cur = db.cursor()
         try:
-            latest = cur.execute("""select
+            latest = db.query_one("""select timestamp, par, side1, side2, side3, side4
+            from letterboxed_puzzles order by timestamp desc limit 1;""")
+            if latest is None:
+                return cls.retrieve_last_saved_json(db_path)
+            timestamp = latest[0]
+            words = [x[0] for x in db.query(
+                "select word from letterboxed_words where timestamp=? order by id;",
+                (timestamp,))]
+            loaded_puzzle = cls(
+                timestamp, [tuple(x) for x in latest[2:6]], words, latest[1])
+            for length, packed in db.query(
+                    """select length, word_ids from letterboxed_solutions
+                    where timestamp=?;""", (timestamp,)):
+                loaded_puzzle.add_solution_set(
+                    length, loaded_puzzle.unpack_solutions(length, packed))
+            for table, words in (
+                    ("letterboxed_user_words", loaded_puzzle.user_found_words),
+                    ("letterboxed_hints", loaded_puzzle.hints_given)):
+                for word_id, in db.query(
+                        f"select word_id from {table} where timestamp=?;", (timestamp,)):
+                    words.add(LetterBoxedWord(loaded_puzzle.word_list[word_id]))
+            return loaded_puzzle
+        except:
+            print("couldn't load latest letterboxed from database")
+            traceback.print_exc()
+            return None
+
+    @classmethod
+    def retrieve_last_saved_json(cls, db_path: str = "db/puzzles.db") -> Optional[LetterBoxed]:
+        """Loads the latest puzzle saved in the old JSON format. Persisting it
+        afterwards saves it in the new format."""
+        db = cls.get_connection(db_path)
+        try:
+            latest = db.query_one("""select
             timestamp, par, side1, side2, side3, side4, valid_words,
             found_solutions, user_found_words, hints_given
-            from letterboxed order by timestamp desc limit 1;""").fetchone()
-            db.close()
+            from letterboxed order by timestamp desc limit 1;""")
             if latest is None:
                 return None
             else:
@@ -286,9 +463,10 @@ class LetterBoxed:
                     [tuple(x) for x in latest[2:6]],
                     json.loads(latest[6]),
                     latest[1])
-                loaded_puzzle.found_solution_sets = {
-                    int(k): LetterBoxedSolutionSet.from_lists(v)
-                    for k, v in json.loads(latest[7]).items()}
+                for k, v in json.loads(latest[7]).items():
+                    loaded_puzzle.add_solution_set(
+                        int(k), LetterBoxedSolutionSet.from_lists(v)
+                    )
                 loaded_puzzle.user_found_words = (
                     set(map(LetterBoxedWord, json.loads(latest[8])))
                 )
@@ -299,7 +477,6 @@ class LetterBoxed:
         except:
             print("couldn't load latest letterboxed from database")
             traceback.print_exc()
-            db.close()
             return None
 
     @classmethod
@@ -348,7 +525,7 @@ class LetterBoxed:
             return None
         else:
             self.hints_given.add(hint_word)
-            self.save()
+            self.save_words("letterboxed_hints", [hint_word])
             hint_word = hint_word.word
         # copy the graphic into a new Soup for modification
         soup = Soup(str(self.graphic), "xml")
@@ -380,110 +557,115 @@ class LetterBoxed:
         return 12
         # or return sum(map(self.sides, len)) for added headaches
 
-    def get_valid_continuation(
-            self,
-            antecedent: Union[LetterBoxedWord, LetterBoxedSolution],
-            min_points=-1,
-            max_points=-1,
-            direction: Direction=Direction.right) -> set[LetterBoxedWord]:
-        """
-        Returns all valid follow-up words with scores in the range [min_points,
-        max_points]. Duplicate words are not considered valid follow-ups.
-        """
-        letter = 0 if direction == Direction.left else -1
-        index = self.reverse_index if direction == Direction.left else self.index
-        if type(antecedent) is LetterBoxedSolution:
-            relevant_word = antecedent.words[-1]
-        else:
-            relevant_word = antecedent
-        relevant_letter = relevant_word[letter]
-        if min_points == -1:
-            min_points = self.min_word_score
-        if max_points == -1:
-            max_points = self.max_word_score
-        result = set()
-        for i in range(min_points, max_points+1):
-            result = result.union(index[relevant_letter][i])
-        result.discard(relevant_word)
-        return result
-
-    def _recursive_search(
-        self,
-        desired_length: int,
-        words_so_far: LetterBoxedSolution = LetterBoxedSolution([]),
-        direction: Direction=Direction.right
-    ) -> Optional[LetterBoxedSolutionSet]:
-        """
-        recursive method. takes a solution that's in the process of being built,
-        finds each possible valid continuation word by searching self.index, and
-        either continues the recursion or returns the resulting solution set.
-        """
-        if words_so_far.is_complete():
-            # premature completion (this method would not have been called if
-            # words_so_far was already the desired length)
-            return None
-        if desired_length == 1:
-            # special case; no recursion required
-            solutions = []
-            for word in self.valid_words:
-                solution = LetterBoxedSolution([word])
-                if solution.is_complete():
-                    solutions.append(solution)
-            return LetterBoxedSolutionSet(solutions)
-        if len(words_so_far) == 0:
-            # we're just starting to build the solution; we can try any word because
-            # we have nothing to follow. we just have to start the recursive calling
-            # and gather and return the results.
-            result = LetterBoxedSolutionSet()
-            for word in self.valid_words:
-                solutions = self._recursive_search(desired_length, LetterBoxedSolution([word]), direction)
-                if solutions is not None:
-                    result += solutions
-            result.finalize()
-            return result
-        elif len(words_so_far) == desired_length-1:
-            # we only need to build and return the final solution set possible with
-            # this "chain" so far
-            result = []
-            for followup in self.get_valid_continuation(
-                    words_so_far, self.needed_letter_count - words_so_far.unique_letters, 12, direction):
-                final = words_so_far + followup if direction == Direction.right else followup + words_so_far
-                if final.is_complete():
-                    result.append(final)
-            return LetterBoxedSolutionSet(result)
-        else:
-            # this is a level of recursion between the beginning and the end; we just
-            # have to continue the chain of words, call, and return the eventual
-            # result. don't bother with words that will prematurely complete the
-            # solution.
-            results = LetterBoxedSolutionSet()
-            for followup in self.get_valid_continuation(
-                    words_so_far, 0, 12 - words_so_far.unique_letters, direction):
-                result = self._recursive_search(
-                    desired_length, 
-                    words_so_far+followup if direction == Direction.right else followup+words_so_far, 
-                    direction)
-                if result is not None:
-                    results += result
-            return results
+    def solution_from_ids(self, word_ids: tuple[int, ...]) -> LetterBoxedSolution:
+        return LetterBoxedSolution([self.solver_words[x] for x in word_ids])
 
     def get_solutions_by_length(
-        self, length: int = 2, direction: Direction=Direction.right
+        self,
+        length: int = 2,
+        direction: Direction=Direction.right,
+        executor: Optional[Executor] = None,
+        shards: int = 16
     ) -> LetterBoxedSolutionSet:
+        """Finds (or returns the already-found) solutions with the given number of
+        words. If executor is given, the search is split up by starting word into
+        shards that are run in that executor."""
         if length in self.found_solution_sets:
             return self.found_solution_sets[length]
+        if executor is None:
+            solution_ids = self.solver.solve(length, direction)
         else:
-            solutions = self._recursive_search(length, direction)
-            self.found_solution_sets[length] = solutions
-            self.save()
-            return solutions
+            results = [
+                x.result() for x in [
+                    executor.submit(solve_shard, self.solver, length, direction, starts)
+                    for starts in shard_starts(len(self.solver.words), shards)
+                ]
+            ]
+            self.report_shard_timings(length, [x[1] for x in results])
+            solution_ids = [x for shard_results, _ in results for x in shard_results]
+        solutions = LetterBoxedSolutionSet(map(self.solution_from_ids, solution_ids))
+        self.add_solution_set(length, solutions)
+        self.save_solutions(length)
+        return solutions
+
+    async def find_solutions(
+        self,
+        lengths: Iterable[int] = (1, 2, 3),
+        processes: int = min(4, os.cpu_count() or 1)
+    ):
+        """Finds the solutions of each of the given lengths in a pool of worker
+        processes without blocking the event loop, so that get_solutions_by_length
+        can return them right away afterwards."""
+        lengths = [x for x in lengths if x not in self.found_solution_sets]
+        if not lengths:
+            return
+        loop = asyncio.get_running_loop()
+        # spawned workers only import what they need to run the search (see main.py)
+        executor = ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            for length in lengths:
+                start = default_timer()
+                shards = [
+                    loop.run_in_executor(
+                        executor, solve_shard, self.solver, length, Direction.right, x
+                    ) for x in shard_starts(len(self.solver.words), 4*processes)
+                ]
+                results = await asyncio.gather(*shards)
+                self.report_shard_timings(
+                    length, [x[1] for x in results], default_timer() - start
+                )
+                solutions = LetterBoxedSolutionSet()
+                for shard_results, _ in results:
+                    solutions.update(map(self.solution_from_ids, shard_results))
+                    # building solution objects for a big shard takes a while
+                    await asyncio.sleep(0)
+                self.add_solution_set(length, solutions)
+                self.save_solutions(length)
+        finally:
+            # if this is cancelled, the shards that are running are left to finish
+            # on their own instead of being waited for on the event loop
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def start_finding_solutions(self) -> asyncio.Task:
+        """Starts find_solutions in the background if it isn't running or done
+        already, and returns its task, which can be awaited by anything that needs
+        the solutions."""
+        if self.solving is None or (
+                self.solving.done() and
+                (self.solving.cancelled() or self.solving.exception() is not None)):
+            self.solving = asyncio.create_task(self.find_solutions())
+        return self.solving
+
+    def add_solution_set(self, length: int, solutions: LetterBoxedSolutionSet):
+        """Stores the solutions of a given length and indexes which words they use,
+        so that checking whether a word is part of a solution is just a lookup."""
+        self.found_solution_sets[length] = solutions
+        for word in solutions.words:
+            self.solution_lengths.setdefault(word, set()).add(length)
+        for solution in solutions.common_word_solutions:
+            for word in solution.words:
+                self.common_solution_lengths.setdefault(word, set()).add(length)
+
+    def report_shard_timings(
+            self,
+            length: int,
+            timings: list[float],
+            elapsed: Optional[float] = None):
+        self.shard_timings[length] = timings
+        print(
+            f"searched for {length}-word letterboxed solutions in {len(timings)} "
+            f"shards; slowest {max(timings, default=0):.3f}s, total "
+            f"{sum(timings):.3f}s" +
+            (f", {elapsed:.3f}s elapsed" if elapsed is not None else "")
+        )
 
     def get_solutions_quantity_statement(self):
 
         def sol(count: int) -> str:
             return add_s("solution", count)
 
-        solutions = {n: self.get_solutions_by_length(n) for n in range(1, 2+1)}
+        solutions = {n: self.get_solutions_by_length(n) for n in range(1, 3+1)}
         result = ""
         if len(solutions[1]):
             one = len(solutions[1])
@@ -491,17 +673,16 @@ class LetterBoxed:
 
         two = len(solutions[2])
         two_r = len(solutions[2].common_word_solutions)
-        # three = len(solutions[3])
-        # three_r = len(solutions[3].common_word_solutions)
+        three = len(solutions[3])
+        three_r = len(solutions[3].common_word_solutions)
         result += (
-            f"There {copula(two)} {num(two)} two-word {sol(two)}. "
-            # f"and {num(three)} three-word {sol(three)}. "
+            f"There {copula(two)} {num(two)} two-word {sol(two)} "
+            f"and {num(three)} three-word {sol(three)}. "
         )
         result += (
             "Limiting ourselves to the most common 100,000 words in the " +
             f"Google Books corpus, there {copula(two_r)} {num(two_r)} two-word " +
-            f"{sol(two_r)}."
-            #" and {num(three_r)} three-word {sol(three_r)}."
+            f"{sol(two_r)} and {num(three_r)} three-word {sol(three_r)}."
         )
 
         return result
@@ -513,35 +694,34 @@ class LetterBoxed:
                 len(self.valid_words))
             * 100, 2)
     
-    def in_three_word_solution(self, word: LetterBoxedWord) -> bool:
-        if not word in self.valid_words:
-            return False
-        befores = self.get_valid_continuation(word, 1, 12, Direction.left)
-        for before in befores:
-            pair = LetterBoxedSolution([before, word])
-            if pair.is_complete():
-                continue
-            continuations = self._recursive_search(3, pair, Direction.right)
-            if len(continuations) > 0:
-                return True
-        return (
-            len(self._recursive_search(3, LetterBoxedSolution([word]), Direction.right)) > 0
-            or
-            len(self._recursive_search(3, LetterBoxedSolution([word]), Direction.left)) > 0
-        )
-
+    def in_solution(
+            self, word: LetterBoxedWord, length: int, common_only: bool = False) -> bool:
+        """Returns whether a word is part of a solution with the given number of
+        words (made up only of common words, if common_only is True.) Searches for
+        the solutions right there if they haven't been found yet, which is slow
+        for three words; in the bot, the solutions should have been found through
+        start_finding_solutions first."""
+        if length not in self.found_solution_sets:
+            self.get_solutions_by_length(length)
+        index = self.common_solution_lengths if common_only else self.solution_lengths
+        return length in index.get(word, ())
 
+    def in_three_word_solution(self, word: LetterBoxedWord) -> bool:
+        return self.in_solution(word, 3)
 
     def react_to_words(self, words: list[str]) -> list[str]:
         reactions = []
-        solutions = {n: self.get_solutions_by_length(n) for n in range(1, 3+1)}
         words: list[LetterBoxedWord] = [LetterBoxedWord(x) for x in words]
+        # only words in the puzzle can be part of a solution, so they're the only
+        # ones that is_common gets called for
+        find_common_words(x.word for x in words if x in self.valid_words)
         # scan single words
-        user_found_words_count = len(self.user_found_words)
+        newly_found_words = []
         for word in words:
-            if word in self.valid_words:
+            if word in self.valid_words and word not in self.user_found_words:
                 self.user_found_words.add(word)
-            if word in solutions[2].words:
+                newly_found_words.append(word)
+            if self.in_solution(word, 2):
                 if word.is_common:
                     reactions.append("🐫")
                 else:
@@ -551,8 +731,8 @@ class LetterBoxed:
                     reactions.append("🌳")
                 else:
                     reactions.append("🥶")
-        if user_found_words_count != len(self.user_found_words):
-            self.save()
+        if newly_found_words:
+            self.save_words("letterboxed_user_words", newly_found_words)
 
         def has_solution(length: int) -> Optional[LetterBoxedSolution]:
             for i in range(len(words)-(length-1)):
@@ -625,6 +805,8 @@ async def post_letterboxed(guild: discord.Guild, thread_id: int):
                 break
     mystery_words = list(map(lambda x: str(x).lower(), mystery_words))
 
+    # the search for three-word solutions is too slow to do on the event loop
+    await new_boxed.start_finding_solutions()
     current_letterboxed = new_boxed
     current_letterboxed.persist()
     new_boxed_image = new_boxed.render()
@@ -647,8 +829,10 @@ async def letterboxed_react(message: discord.Message):
     words = re.sub("\W", " ", message.content).split()
     if current_letterboxed is None:
         current_letterboxed = await LetterBoxed.fetch_from_nyt()
-    for reaction in current_letterboxed.react_to_words(words):
-        await message.add_reaction(reaction)
+    # react_to_words needs the solutions; this waits for the search that was started
+    # when the puzzle was loaded (or starts one) instead of searching on the loop
+    await current_letterboxed.start_finding_solutions()
+    reaction_scheduler.set_reactions(message, current_letterboxed.react_to_words(words))
 
 
 def add_letterboxed_functionality(client: MitchBot):
@@ -663,8 +847,7 @@ def add_letterboxed_functionality(client: MitchBot):
             # in case we want to test puzzle posting directly
             post_new_letterboxed_at = (datetime.now(tz=et)+timedelta(seconds=5)).time()
     client.register_responder(MessageResponder(
-        lambda m: m.channel.id == letterboxed_thread_id,
-        letterboxed_react))
+        None, letterboxed_react, channel_id=letterboxed_thread_id, max_concurrency=1))
     asyncio.create_task(
         repeatedly_schedule_task_for(
             post_new_letterboxed_at,
@@ -672,6 +855,9 @@ def add_letterboxed_functionality(client: MitchBot):
                 client.get_guild(letterboxed_guild_id),
                 letterboxed_thread_id),
             "post_letterboxed"))
+    if current_letterboxed is not None:
+        # older saved puzzles might not have their three-word solutions yet
+        current_letterboxed.start_finding_solutions()
 
     async def obtain_hint(context: ApplicationCommandInteraction):
         if current_letterboxed:
@@ -0,0 +1,139 @@
+"""
+The part of the Letter Boxed code that finds solutions. It is kept apart from
+letterboxed.py, which talks to discord and the NYT and loads its data when it is
+imported, so that the search can be sent to worker processes cheaply.
+"""
+
+from __future__ import annotations
+from enum import Enum
+from timeit import default_timer as timer
+from typing import Iterable, Optional
+
+
+class Direction(Enum):
+    left="left"
+    right="right"
+
+
+class LetterBoxedSolver:
+    """
+    Solution enumeration engine that works with integers instead of word objects.
+    Each word gets an id (its index in self.words) and is represented by a 12-bit
+    mask of the puzzle letters it uses plus the ids of its first and last letters;
+    words are then grouped by first letter (and, for searching right-to-left, by
+    last letter) and, within that, by mask. A chain of words is extended by OR-ing
+    masks together, so checking whether a chain uses every letter is a single
+    comparison, and the last word of a chain only has to be looked for among the
+    distinct masks that cover all of the missing letters. Solutions come out as
+    tuples of word ids.
+    """
+
+    def __init__(self, sides: list[tuple[str, ...]], words: list[str]):
+        letters = [letter.upper() for side in sides for letter in side]
+        letter_ids = {letter: i for i, letter in enumerate(letters)}
+        self.full_mask = (1 << len(letters)) - 1
+        self.words: list[str] = []
+        self.masks: list[int] = []
+        self.first: list[int] = []
+        self.last: list[int] = []
+        for word in words:
+            word = word.upper()
+            if not word or any(letter not in letter_ids for letter in word):
+                continue
+            mask = 0
+            for letter in word:
+                mask |= 1 << letter_ids[letter]
+            self.words.append(word)
+            self.masks.append(mask)
+            self.first.append(letter_ids[word[0]])
+            self.last.append(letter_ids[word[-1]])
+        self.ids = {word: i for i, word in enumerate(self.words)}
+        self.most_letters = max((x.bit_count() for x in self.masks), default=0)
+        # for each letter id, a list of (mask, [word ids]) pairs for the words that
+        # start (or end) with that letter
+        self.starting_with = self._group(self.first)
+        self.ending_with = self._group(self.last)
+
+    def _group(self, letter_of: list[int]) -> list[list[tuple[int, list[int]]]]:
+        groups: list[dict[int, list[int]]] = [{} for _ in range(self.full_mask.bit_length())]
+        for word_id, letter in enumerate(letter_of):
+            groups[letter].setdefault(self.masks[word_id], []).append(word_id)
+        return [list(x.items()) for x in groups]
+
+    def solve(
+            self,
+            length: int,
+            direction: Direction = Direction.right,
+            starts: Optional[Iterable[int]] = None) -> list[tuple[int, ...]]:
+        """
+        Returns every chain of length words that uses all of the letters, where each
+        word starts with the last letter of the one before it, no word directly
+        follows itself, and no shorter chain at the starting end (the beginning for
+        Direction.right, the end for Direction.left) already uses all of the
+        letters. starts can be used to only search the chains that begin (or, for
+        Direction.left, end) with certain word ids.
+        """
+        if starts is None:
+            starts = range(len(self.words))
+        full = self.full_mask
+        masks = self.masks
+        if length == 1:
+            return [(x,) for x in starts if masks[x] == full]
+        if direction == Direction.right:
+            adjacent, link_of = self.starting_with, self.last
+        else:
+            adjacent, link_of = self.ending_with, self.first
+        most_letters = self.most_letters
+        results: list[tuple[int, ...]] = []
+
+        def extend(chain: tuple[int, ...], mask: int, remaining: int):
+            previous = chain[-1]
+            missing = full & ~mask
+            if remaining == 1:
+                for word_mask, word_ids in adjacent[link_of[previous]]:
+                    if word_mask & missing == missing:
+                        for word_id in word_ids:
+                            if word_id != previous:
+                                results.append(chain + (word_id,))
+                return
+            for word_mask, word_ids in adjacent[link_of[previous]]:
+                new_mask = mask | word_mask
+                if new_mask == full:
+                    # the chain would be finished too early
+                    continue
+                if (full & ~new_mask).bit_count() > most_letters * (remaining-1):
+                    # too many letters left for the words that are left
+                    continue
+                for word_id in word_ids:
+                    if word_id != previous:
+                        extend(chain + (word_id,), new_mask, remaining-1)
+
+        for start in starts:
+            if masks[start] == full:
+                continue
+            if (full & ~masks[start]).bit_count() > most_letters * (length-1):
+                continue
+            extend((start,), masks[start], length-1)
+        if direction == Direction.left:
+            # chains were built backwards
+            results = [x[::-1] for x in results]
+        return results
+
+
+def solve_shard(
+        solver: LetterBoxedSolver,
+        length: int,
+        direction: Direction,
+        starts: Iterable[int]) -> tuple[list[tuple[int, ...]], float]:
+    """Runs one piece of a search (usually in a worker process) and returns its
+    results along with how long it took."""
+    start = timer()
+    results = solver.solve(length, direction, starts)
+    return results, timer() - start
+
+
+def shard_starts(word_count: int, shards: int) -> list[range]:
+    """Splits up the starting word ids for a search. The ids are dealt out like
+    cards instead of being cut into blocks so that each shard gets a similar mix of
+    the words that have lots of solutions and the words that have none."""
+    return [range(i, word_count, shards) for i in range(min(shards, word_count))]
@@ -1,26 +1,40 @@
 # python libraries
 import asyncio
 import logging
+import signal
 
 # external libraries
 
-# project files
-from MitchBot import MitchBot
 
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s: %(levelname)s: %(name)s: %(message)s'))
-logger.addHandler(handler)
+def setup_logging():
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s: %(levelname)s: %(name)s: %(message)s'))
+    logger.addHandler(handler)
 
 
 async def main():
+    # project files; imported here so that worker processes, which import this file
+    # again, don't load the whole bot
+    from MitchBot import MitchBot
+
     discord_client = MitchBot()
+    # docker stop sends SIGTERM, which would otherwise end the process without
+    # closing the bot (or running atexit functions)
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.create_task(discord_client.close()))
+    except NotImplementedError:
+        pass
     with open('login_token.txt') as token_file:
         await discord_client.login(token_file.read())
     await discord_client.connect()
 
+# worker processes started with spawn import this file again (without running it as
+# __main__), so nothing outside of this block should have side effects
 if __name__ == "__main__":
+    setup_logging()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
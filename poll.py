@@ -1,3 +1,4 @@
+import asyncio
 from collections import defaultdict
 from typing import Optional, Union
 import disnake as discord
@@ -10,7 +11,9 @@ DROPDOWN_ID = "movie dropdown"
 SUGGEST_BUTTON_ID = "suggest a movie"
 ABSTENTION = "Abstain from vote 👐"
 
-db = pw.SqliteDatabase('db/polls.db')
+# same settings as the databases opened through db/database.py
+db = pw.SqliteDatabase(
+    'db/polls.db', pragmas={'journal_mode': 'wal', 'synchronous': 'normal'})
 
 class BaseModel(pw.Model):
     class Meta:
@@ -71,18 +74,47 @@ class SuggestModal(discord.ui.Modal):
         if len(added_movie.strip()) == 0:
             await action.response.send_message("not valid", ephemeral=True)
             return
-        original_message_id = action.message.id
-        poll: Poll = Poll.get_or_create(message_id=original_message_id)[0]
-        try:
-            MovieOption.create(
-                added_by_id=action.author.id, 
-                name=added_movie, 
-                in_poll=original_message_id).save()
-        except: pass
+        poll = await asyncio.to_thread(
+            add_movie_option, action.message.id, action.author.id, added_movie)
         await action.response.edit_message(
             content=poll_model_to_vote_count(poll),
             view=poll_model_to_view(poll))
 
+# the functions that write to the database are run with asyncio.to_thread so that
+# commits don't hold up the event loop; peewee gives each thread its own connection
+
+def add_movie_option(poll_id: int, added_by_id: int, name: str) -> Poll:
+    with db.atomic():
+        poll: Poll = Poll.get_or_create(message_id=poll_id)[0]
+        try:
+            with db.atomic():
+                MovieOption.create(
+                    added_by_id=added_by_id,
+                    name=name,
+                    in_poll=poll_id).save()
+        except: pass
+    return poll
+
+def record_vote(poll_id: int, voter_id: int, voter_nickname: str, selection: str) -> Poll:
+    with db.atomic():
+        poll: Poll = Poll.get_or_create(message_id=poll_id)[0]
+        try:
+            Vote.get(
+                Vote.in_poll==poll_id and Vote.voter_id==voter_id
+            ).delete_instance()
+        except pw.DoesNotExist: pass
+        if not (len(selection) == 0 or selection == ABSTENTION):
+            movie = MovieOption.get(
+                MovieOption.in_poll==poll_id and
+                MovieOption.name==selection
+            )
+            Vote.create(what_for=movie.id,
+                in_poll=poll_id,
+                voter_id=voter_id,
+                voter_nickname=voter_nickname
+            ).save()
+    return poll
+
 def poll_model_to_view(poll: Optional[Poll]=None) -> discord.ui.View:
     options = [x.name for x in poll.options] if poll != None else []
     view = discord.ui.View(timeout=None)
@@ -128,28 +160,12 @@ def add_poll_functionality(bot: Bot):
         if action.component.custom_id != DROPDOWN_ID:
             await action.response.defer()
             return
-        message = action.message
-        poll_id = message.id
-        poll: Poll = Poll.get_or_create(message_id=poll_id)[0]
-        try:
-            Vote.get(
-                Vote.in_poll==poll_id and Vote.voter_id==action.author.id
-            ).delete_instance()
-        except pw.DoesNotExist: pass
         selection = action.values[0]
         voter_nickname = (action.author.nick 
             if isinstance(action.author.nick, str) 
             else action.author.name)
-        if not (len(selection) == 0 or selection == ABSTENTION):
-            movie = MovieOption.get(
-                MovieOption.in_poll==poll_id and
-                MovieOption.name==selection
-            )
-            Vote.create(what_for=movie.id,
-                in_poll=poll_id,
-                voter_id=action.author.id,
-                voter_nickname=voter_nickname
-            ).save()
+        poll = await asyncio.to_thread(
+            record_vote, action.message.id, action.author.id, voter_nickname, selection)
         await action.response.edit_message(
             content=poll_model_to_vote_count(poll),
             view=poll_model_to_view(poll))
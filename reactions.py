@@ -0,0 +1,152 @@
+"""
+Puts reactions on messages without flooding Discord with requests. Instead of adding
+(and, when a message is edited, removing) reactions one after another, callers say
+which reactions a message should have and the ReactionScheduler works out and makes
+only the changes, pacing the requests for each channel so that they stay inside
+Discord's rate limits instead of running into them and getting retried.
+"""
+
+from __future__ import annotations
+import asyncio
+from timeit import default_timer as timer
+import traceback
+from typing import Optional
+
+import disnake as discord
+
+from caching import LRUCache
+
+
+class ReactionScheduler:
+    """
+    Brings the bot's reactions on messages in line with lists of desired reactions.
+    Reaction requests are limited by Discord per channel (to about one every quarter
+    of a second), so requests for each channel are spaced out by min_interval while
+    different channels go ahead in parallel. If new reactions are requested for a
+    message while an earlier request for it is still being worked on, the earlier
+    one is cancelled and the new one starts from whatever had been done so far.
+    Cancellation only takes effect between requests: a request that has already been
+    sent is always seen through, so that what the bot thinks it has applied stays
+    in line with what Discord has.
+    """
+
+    def __init__(self, min_interval: float = 0.3, remembered_messages: int = 1000):
+        self.min_interval = min_interval
+        # the reactions that the bot is known to have put on recent messages, which
+        # can be more up to date than the reactions in discord's message objects
+        self.applied = LRUCache(remembered_messages, lambda _: 1)
+        self.tasks: dict[int, asyncio.Task] = {}
+        # the request that is currently being made for each message, which keeps
+        # going even if the task that made it is cancelled
+        self.requests: dict[int, asyncio.Task] = {}
+        # the earliest time at which the next request in each channel can be made
+        self.next_slot: dict[int, float] = {}
+        self.added = 0
+        self.removed = 0
+        # reactions that didn't need a request because they were already in place
+        self.unchanged = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def set_reactions(self, message: discord.Message, reactions: list[str]) -> asyncio.Task:
+        """Starts changing the bot's reactions on message to reactions (in that
+        order) and returns the task that does it; there's no need to await it."""
+        stale = self.tasks.pop(message.id, None)
+        if stale is not None and not stale.done():
+            stale.cancel()
+            self.cancelled += 1
+        task = asyncio.create_task(self._apply(message, list(dict.fromkeys(reactions))))
+        self.tasks[message.id] = task
+        task.add_done_callback(lambda t: self._finished(message.id, t))
+        return task
+
+    def _finished(self, message_id: int, task: asyncio.Task):
+        if self.tasks.get(message_id) is task:
+            del self.tasks[message_id]
+
+    def current_reactions(self, message: discord.Message) -> list[str]:
+        applied: Optional[list[str]] = self.applied.get(message.id)
+        if applied is not None:
+            return applied
+        return [str(x.emoji) for x in message.reactions if x.me]
+
+    async def _wait_for_slot(self, channel_id: int):
+        now = timer()
+        slot = max(now, self.next_slot.get(channel_id, now))
+        self.next_slot[channel_id] = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _request(
+            self,
+            message: discord.Message,
+            current: list[str],
+            reaction: str,
+            add: bool) -> bool:
+        """Adds or removes one reaction and records the change in current. Returns
+        False if that didn't work."""
+        try:
+            if add:
+                await message.add_reaction(reaction)
+                current.append(reaction)
+                self.added += 1
+            else:
+                me = message.guild.me if message.guild is not None else message.channel.me
+                await message.remove_reaction(reaction, me)
+                current.remove(reaction)
+                self.removed += 1
+            return True
+        except Exception:
+            self.failed += 1
+            # we don't know what state the message is in anymore
+            self.applied.pop(message.id)
+            print(f"could not update reactions on message {message.id}:")
+            traceback.print_exc()
+            return False
+
+    def _request_finished(self, message_id: int, request: asyncio.Task):
+        if self.requests.get(message_id) is request:
+            del self.requests[message_id]
+
+    async def _apply(self, message: discord.Message, desired: list[str]):
+        try:
+            # if a cancelled task left a request going, its result is needed
+            # before working out what to change
+            in_flight = self.requests.get(message.id)
+            if in_flight is not None:
+                await asyncio.wait([in_flight])
+            current = list(self.current_reactions(message))
+            self.applied.put(message.id, current)
+            to_remove = [x for x in current if x not in desired]
+            to_add = [x for x in desired if x not in current]
+            self.unchanged += len(desired) - len(to_add)
+            changes = [(x, False) for x in to_remove] + [(x, True) for x in to_add]
+            for reaction, add in changes:
+                await self._wait_for_slot(message.channel.id)
+                request = asyncio.create_task(
+                    self._request(message, current, reaction, add))
+                self.requests[message.id] = request
+                request.add_done_callback(
+                    lambda r: self._request_finished(message.id, r))
+                if not await asyncio.shield(request):
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            self.applied.pop(message.id)
+            print(f"could not update reactions on message {message.id}:")
+            traceback.print_exc()
+
+    def stats(self) -> dict:
+        return {
+            "in_progress": len(self.tasks),
+            "added": self.added,
+            "removed": self.removed,
+            "unchanged": self.unchanged,
+            "cancelled": self.cancelled,
+            "failed": self.failed,
+        }
+
+
+reaction_scheduler = ReactionScheduler()
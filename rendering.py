@@ -0,0 +1,440 @@
+"""
+Image compositing for the fight, kiss, and emoji commands. Decoding, resizing,
+pasting, and PNG encoding are all CPU-bound, so instead of doing them on the event
+loop (where they hold up gateway heartbeats and every other responder), they are
+done by the functions in this file inside a RenderPool. The functions are defined at
+the module level so that they can be sent to a process pool if need be; the template
+images they use are decoded once per process and kept in the AssetRegistry. Puzzle
+graphics, which take much longer, go through a PuzzleRenderPipeline. Run this file
+directly to benchmark the pool against rendering on the event loop. Like everything
+else, this expects the CWD to be the root directory of the repository.
+"""
+
+from __future__ import annotations
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import multiprocessing
+import os
+import random
+import threading
+import traceback
+from timeit import default_timer as timer
+from typing import Any, Callable, Optional
+
+from PIL import Image, ImageSequence
+
+from executor import LatencyCounter
+
+
+class AssetRegistry:
+    """
+    Decodes the template images used for compositing once and keeps them in memory.
+    The cached images are shared, so they must never be modified; use copy() to get
+    one that can be drawn on. If hot_reload is True, each access checks the file's
+    modification time and reloads it if it has changed, so templates can be edited
+    while the bot is running.
+    """
+
+    def __init__(self, paths: dict[str, str], hot_reload: bool = False):
+        self.paths = paths
+        self.hot_reload = hot_reload
+        self._images: dict[str, Image.Image] = {}
+        self._mtimes: dict[str, float] = {}
+        # render functions run in several threads at once
+        self._lock = threading.Lock()
+
+    def _load(self, name: str):
+        path = self.paths[name]
+        mtime = os.stat(path).st_mtime
+        with Image.open(path) as image:
+            converted = image.convert("RGBA")
+        self._images[name] = converted
+        self._mtimes[name] = mtime
+
+    def preload(self):
+        with self._lock:
+            for name in self.paths:
+                self._load(name)
+
+    def get(self, name: str) -> Image.Image:
+        """Returns the cached, read-only version of an image."""
+        if name not in self._images or (
+                self.hot_reload and os.stat(self.paths[name]).st_mtime != self._mtimes[name]):
+            with self._lock:
+                self._load(name)
+        return self._images[name]
+
+    def copy(self, name: str) -> Image.Image:
+        """Returns a copy of an image that can be modified."""
+        return self.get(name).copy()
+
+    def version(self, name: str) -> float:
+        """Returns the modification time of the file an image was loaded from."""
+        self.get(name)
+        return self._mtimes[name]
+
+
+assets = AssetRegistry({
+    "fight": "images/fight.png",
+    "fight_mask": "images/mask.png",
+    "kiss": "images/kiss.png",
+    "kiss_mask": "images/mask_rect.png",
+})
+
+
+def resize_avatar(avatar_file: bytes, final_size: int) -> Image.Image:
+    return Image.open(BytesIO(avatar_file)).resize(
+        (final_size, final_size), Image.LANCZOS
+    )
+
+
+def render_fight(avatar1: Image.Image, avatar2: Image.Image) -> bytes:
+    bg = assets.copy("fight")
+    blank = Image.new("RGBA", (640, 200), 0)
+    mask = assets.get("fight_mask")
+    blank.paste(avatar1, (10, 10))
+    blank.paste(avatar2, (640-10-180, 10))
+    bg.paste(blank, (0, 0), mask)
+    image_bytes = BytesIO()
+    bg.save(image_bytes, format='PNG')
+    return image_bytes.getvalue()
+
+
+def render_kiss(avatar: Image.Image) -> bytes:
+    blank = Image.new('RGBA', (200, 200), 0)
+    mask = assets.get("kiss_mask")
+    blank.paste(avatar, (0, 0), mask)
+    smooch = assets.get("kiss")
+    final = Image.alpha_composite(blank, smooch)
+    image_bytes = BytesIO()
+    final.save(image_bytes, format='PNG')
+    return image_bytes.getvalue()
+
+
+class EmojiImageError(Exception):
+    """Raised when an uploaded image can't or shouldn't be made into an emoji. The
+    message is meant to be shown to the user."""
+
+
+EMOJI_SIZE = 128
+# checked against the size and dimensions that discord reports for an attachment
+# before it is downloaded and against the image header before it is decoded
+MAX_EMOJI_UPLOAD_BYTES = 10*1024*1024
+MAX_EMOJI_SOURCE_PIXELS = 4096*4096
+MAX_EMOJI_FRAMES = 200
+EMOJI_FORMATS = ["jpeg", "png", "gif"]
+
+
+def check_emoji_source(size: int, width: Optional[int], height: Optional[int]):
+    """Raises an EmojiImageError if an upload's declared size or dimensions are too
+    big or missing (which means discord doesn't think it's an image.)"""
+    if size > MAX_EMOJI_UPLOAD_BYTES:
+        raise EmojiImageError(
+            f"that file is too big; it needs to be under "
+            f"{MAX_EMOJI_UPLOAD_BYTES//(1024*1024)} MB")
+    if width is None or height is None:
+        raise EmojiImageError("that doesn't look like an image")
+    if width * height > MAX_EMOJI_SOURCE_PIXELS:
+        raise EmojiImageError("that image has way too many pixels")
+
+
+def _emoji_dimensions(width: int, height: int) -> tuple[int, int]:
+    # the largest dimension becomes 128 pixels to help with file size
+    scale_factor = EMOJI_SIZE/max(width, height)
+    return (max(1, round(width * scale_factor)), max(1, round(height * scale_factor)))
+
+
+def _resize_emoji_frame(frame: Image.Image) -> Image.Image:
+    # reducing_gap lets big images be shrunk by a cheap integer reduction before the
+    # final LANCZOS pass
+    return frame.resize(
+        _emoji_dimensions(frame.width, frame.height),
+        resample=Image.LANCZOS, reducing_gap=3.0)
+
+
+def prepare_emoji(emoji_file: bytes) -> bytes:
+    """
+    Turns an uploaded image into an emoji-sized PNG, or into an emoji-sized GIF if
+    it is animated. The header is checked before anything is decoded; large JPEGs
+    are decoded at a reduced scale; and animated images are resized one frame at a
+    time so that only one full-size frame is decoded at once.
+    """
+    try:
+        emoji_image = Image.open(BytesIO(emoji_file), formats=EMOJI_FORMATS)
+    except Image.DecompressionBombError:
+        raise EmojiImageError("that image has way too many pixels")
+    except Image.UnidentifiedImageError:
+        raise EmojiImageError("that isn't a PNG, JPEG, or GIF I can read")
+    with emoji_image:
+        if emoji_image.width * emoji_image.height > MAX_EMOJI_SOURCE_PIXELS:
+            raise EmojiImageError("that image has way too many pixels")
+        frame_count = getattr(emoji_image, "n_frames", 1)
+        if frame_count > 1:
+            if frame_count > MAX_EMOJI_FRAMES:
+                raise EmojiImageError("that animation has too many frames")
+            frames = []
+            durations = []
+            for frame in ImageSequence.Iterator(emoji_image):
+                durations.append(frame.info.get("duration", 100))
+                frames.append(_resize_emoji_frame(frame.convert("RGBA")))
+            result = BytesIO()
+            frames[0].save(
+                result, format="gif", save_all=True, append_images=frames[1:],
+                duration=durations, loop=emoji_image.info.get("loop", 0), disposal=2)
+            return result.getvalue()
+        if emoji_image.format == "JPEG":
+            # lets the decoder skip straight to a smaller scale (in powers of two)
+            # instead of decoding every pixel of a giant photo
+            emoji_image.draft("RGB", _emoji_dimensions(emoji_image.width, emoji_image.height))
+        resized = _resize_emoji_frame(emoji_image)
+        result = BytesIO()
+        resized.save(result, format="png")
+        return result.getvalue()
+
+
+class RenderPool:
+    """
+    Runs image functions in a pool of worker threads (or processes, if
+    use_processes is True) and exposes them through an async API. At most
+    max_pending renders can be queued up or running at once; callers beyond that
+    wait their turn on the event loop without using any CPU. PIL releases the GIL
+    for most of the heavy lifting, so threads are usually enough; processes avoid
+    the GIL completely at the cost of pickling the images back and forth.
+    """
+
+    def __init__(
+            self,
+            workers: int = min(4, os.cpu_count() or 1),
+            max_pending: int = 16,
+            use_processes: bool = False):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        # created lazily so that importing this file doesn't start any workers
+        self._executor: Executor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        # renders that have been submitted but not finished, including the ones
+        # that are waiting for a slot
+        self.pending = 0
+        self.completed = 0
+        self.busy_time = 0.0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="render")
+        return self._executor
+
+    async def run(self, function: Callable, *args: Any) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.pending += 1
+        try:
+            async with self._slots:
+                start = timer()
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, function, *args
+                )
+                self.completed += 1
+                self.busy_time += timer() - start
+                return result
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+render_pool = RenderPool()
+
+
+def render_puzzle(puzzle: Any, style: str) -> tuple[bytes, str]:
+    """Renders a puzzle object (like a SpellingBee) whose render method is a
+    coroutine and returns the image and its file type. Meant to be run in a worker
+    process."""
+    asyncio.run(puzzle.render(style))
+    return puzzle.image, puzzle.image_file_type
+
+
+class PuzzleRenderPipeline:
+    """
+    Makes puzzle graphics in a long-lived worker process, so that a slow or stuck
+    render can't hold up the bot, and keeps the results in cache_dir so that a puzzle is
+    never rendered in the same style twice, even across restarts. Cache files are
+    named for the puzzle's letters and the render style. If a render takes longer
+    than timeout seconds or fails, the puzzle is rendered in fallback_style on the
+    event loop instead. How long renders take is recorded for each style.
+    """
+
+    def __init__(
+            self,
+            cache_dir: str,
+            timeout: float = 8*60,
+            fallback_style: str = "hexspin"):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.fallback_style = fallback_style
+        # started the first time something is rendered, and replaced if a render
+        # gets stuck or the worker dies
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.durations: dict[str, LatencyCounter] = {}
+        self.cache_hits = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def _cache_stem(self, puzzle: Any, style: str) -> str:
+        letters = puzzle.center + "".join(sorted(puzzle.outside))
+        return os.path.join(self.cache_dir, f"{letters}-{style or 'default'}".lower())
+
+    def _load_cached(self, puzzle: Any, style: str) -> Optional[tuple[bytes, str]]:
+        stem = self._cache_stem(puzzle, style)
+        for file_type in ("png", "gif"):
+            if os.path.exists(f"{stem}.{file_type}"):
+                with open(f"{stem}.{file_type}", "rb") as cached_file:
+                    return cached_file.read(), file_type
+        return None
+
+    def _save_cached(self, puzzle: Any, style: str, image: bytes, file_type: str):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = f"{self._cache_stem(puzzle, style)}.{file_type}"
+        with open(path + ".tmp", "wb") as cache_file:
+            cache_file.write(image)
+        os.replace(path + ".tmp", path)
+
+    async def _render_in_process(self, puzzle: Any, style: str) -> tuple[bytes, str]:
+        if self.executor is None:
+            # spawned rather than forked, so the worker only imports what rendering
+            # needs (main.py keeps the rest of the bot out of worker processes)
+            self.executor = ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn"))
+        executor = self.executor
+        try:
+            return await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(
+                    executor, render_puzzle, puzzle, style),
+                self.timeout)
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            if self.executor is executor:
+                self.executor = None
+            # shutdown doesn't stop a render that is still going, so the worker is
+            # also stopped directly (without waiting for it to exit)
+            processes = list((executor._processes or {}).values())
+            executor.shutdown(wait=False, cancel_futures=True)
+            for process in processes:
+                process.terminate()
+            raise
+
+    async def render(self, puzzle: Any, style: str = ""):
+        """Sets puzzle.image and puzzle.image_file_type, from the cache if
+        possible."""
+        cached = self._load_cached(puzzle, style)
+        if cached is None:
+            start = timer()
+            try:
+                image, file_type = await self._render_in_process(puzzle, style)
+                self.durations.setdefault(style or "default", LatencyCounter()).record(
+                    timer() - start)
+                self._save_cached(puzzle, style, image, file_type)
+                cached = image, file_type
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                print(f"rendering puzzle in style \"{style}\" timed out")
+            except Exception:
+                self.failures += 1
+                print(f"could not render puzzle in style \"{style}\":")
+                traceback.print_exc()
+            if cached is None and style != self.fallback_style:
+                cached = self._load_cached(puzzle, self.fallback_style)
+                if cached is None:
+                    start = timer()
+                    await puzzle.render(self.fallback_style)
+                    self.durations.setdefault(
+                        self.fallback_style, LatencyCounter()).record(timer() - start)
+                    cached = puzzle.image, puzzle.image_file_type
+                    self._save_cached(puzzle, self.fallback_style, *cached)
+            elif cached is None:
+                raise RuntimeError("could not render puzzle")
+        else:
+            self.cache_hits += 1
+        puzzle.image, puzzle.image_file_type = cached
+
+    def stats(self) -> dict:
+        return {
+            "durations": dict(self.durations),
+            "cache_hits": self.cache_hits,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+        }
+
+
+async def benchmark(renders: int = 48, concurrency: int = 8):
+    """Compares rendering fight images directly on the event loop with rendering
+    them in a thread pool and in a process pool, reporting images per second and
+    the worst and average delay experienced by a task that wants to run on the
+    event loop every 10 milliseconds."""
+
+    def random_avatar() -> Image.Image:
+        return Image.frombytes(
+            "RGB", (180, 180), random.randbytes(180*180*3)).convert("RGBA")
+
+    avatars = [random_avatar() for _ in range(8)]
+
+    async def measure(label: str, render: Callable):
+        lags = []
+        stop = False
+
+        async def ticker():
+            while not stop:
+                before = timer()
+                await asyncio.sleep(0.01)
+                lags.append(timer() - before - 0.01)
+
+        ticking = asyncio.create_task(ticker())
+        queue = list(range(renders))
+
+        async def renderer():
+            while queue:
+                queue.pop()
+                await render(*random.sample(avatars, 2))
+
+        start = timer()
+        await asyncio.gather(*(renderer() for _ in range(concurrency)))
+        elapsed = timer() - start
+        stop = True
+        await ticking
+        print(
+            f"{label}: {renders/elapsed:.1f} images/sec; event loop lag "
+            f"max {max(lags)*1000:.1f}ms, average {sum(lags)/len(lags)*1000:.1f}ms"
+        )
+
+    async def on_loop(avatar1, avatar2):
+        render_fight(avatar1, avatar2)
+        await asyncio.sleep(0)  # let the ticker in between renders, at least
+
+    await measure("on the event loop", on_loop)
+    thread_pool = RenderPool()
+    await measure(
+        f"in {thread_pool.workers} threads",
+        lambda a, b: thread_pool.run(render_fight, a, b))
+    thread_pool.shutdown()
+    process_pool = RenderPool(use_processes=True)
+    await process_pool.run(render_fight, *avatars[:2])  # start up the processes
+    await measure(
+        f"in {process_pool.workers} processes",
+        lambda a, b: process_pool.run(render_fight, a, b))
+    process_pool.shutdown()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(benchmark())
+    except KeyboardInterrupt:
+        print("Received SIGINT, exiting")
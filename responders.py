@@ -10,14 +10,19 @@ import traceback
 import disnake as discord
 from disnake.interactions import ApplicationCommandInteraction
 from disnake.ext.commands import Param
-from PIL import Image
 
-from typing import TYPE_CHECKING, Union, Callable
+from typing import TYPE_CHECKING, Optional, Union, Callable
 if TYPE_CHECKING:
     from MitchBot import MitchBot
     from asyncio.futures import Future
 
-from db.queries import get_random_nickname, get_random_strategy
+from db.queries import get_random_nickname, get_random_strategy, nicknames, corpora
+from executor import OverloadPolicy
+from rendering import (
+    assets, render_pool, render_fight, render_kiss, check_emoji_source, prepare_emoji,
+    EmojiImageError
+)
+from caching import render_cache
 
 
 class MessageResponder():
@@ -29,23 +34,61 @@ class MessageResponder():
     def __init__(
         self,
         condition: Union[str, list[str],
-                         Callable[[discord.Message], bool]],
+                         Callable[[discord.Message], bool], None],
         responder: Union[Callable[[discord.Message], None],
                          Callable[[discord.Message], Future]],
-            require_mention: bool = False):
+            require_mention: bool = False,
+            channel_id: Optional[int] = None,
+            guild_id: Optional[int] = None,
+            include_threads: bool = False,
+            max_concurrency: int = 3,
+            overload: OverloadPolicy = OverloadPolicy.drop_newest,
+            busy_reply: Optional[str] = None):
         '''
         Args:
             condition: either a string or list of strings that can be used as a
             regular expression to search the message contents case-insensitively
             or a function that returns true or false depending on whether the
-            MessageResponder should respond.
+            MessageResponder should respond. None means that every message in
+            the responder's scope meets the condition.
             responder: a function that is called with the message that we are
             potentially going to respond to. this can be a normal function that
             potentially returns a future or an async function.
+            channel_id: if given, only messages in this channel are responded to.
+            threads count as channels, so this can also be a thread id.
+            guild_id: if given, only messages in this guild are responded to.
+            include_threads: if True, messages in threads whose parent channel is
+            channel_id are also responded to.
+            max_concurrency: how many messages this responder can be responding to
+            at once when it is run by a ResponderExecutor.
+            overload: what a ResponderExecutor should do with messages for this
+            responder when their channel's queue is full.
+            busy_reply: if given, the reply sent to messages that this responder
+            can't get to because their channel's queue is full.
         '''
         self.condition = condition
         self.responder = responder
         self.require_mention = require_mention
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.include_threads = include_threads
+        self.max_concurrency = max_concurrency
+        self.overload = overload
+        self.busy_reply = busy_reply
+        # string and list conditions are joined into one regular expression and
+        # compiled up front so that nothing has to be compiled per message
+        self.pattern: Optional[str] = None
+        if isinstance(condition, str):
+            self.pattern = condition
+        elif isinstance(condition, list):
+            self.pattern = "|".join(f"(?:{regex})" for regex in condition)
+        self.compiled_pattern: Optional[re.Pattern] = (
+            re.compile(self.pattern, re.IGNORECASE) if self.pattern is not None else None
+        )
+        # used to label this responder's latency counters
+        self.name: str = getattr(responder, "__name__", "<responder>")
+        if self.name == "<lambda>" and self.pattern is not None:
+            self.name = self.pattern[:40]
 
     @staticmethod
     def mentions_bot(message: discord.Message):
@@ -53,37 +96,221 @@ class MessageResponder():
             message.guild.me.mentioned_in(message)
             or len(set(message.guild.me.roles).intersection(message.role_mentions)) > 0)
 
+    def in_scope(self, message: discord.Message) -> bool:
+        if self.channel_id is not None and message.channel.id != self.channel_id:
+            if not (self.include_threads and
+                    getattr(message.channel, "parent_id", None) == self.channel_id):
+                return False
+        if self.guild_id is not None and (
+                message.guild is None or message.guild.id != self.guild_id):
+            return False
+        return True
+
+    def condition_met(self, message: discord.Message) -> bool:
+        if self.compiled_pattern is not None:
+            return self.compiled_pattern.search(message.content) is not None
+        if self.condition is None:
+            return True
+        return inspect.isfunction(self.condition) and bool(self.condition(message))
+
+    async def run(self, message: discord.Message):
+        '''
+        Calls the responder function with the message and waits for the result if
+        it is asynchronous.
+        '''
+        result = self.responder(message)
+        if inspect.isawaitable(result):
+            await result
+
+    def respond(self, message: discord.Message):
+        '''
+        Calls the responder function with the message, creating a task for the
+        result if it is asynchronous. Prefer ResponderExecutor.submit, which bounds
+        how much of this can be going on at once.
+        '''
+        if inspect.iscoroutinefunction(self.responder):
+            asyncio.create_task(self.responder(message))
+        else:
+            potential_future = self.responder(message)
+            if potential_future is not None:
+                asyncio.create_task(potential_future)
+
     def react_to(self, message: discord.Message):
         '''
         Reacts to messages by executing a function if the certain condition is
         fulfilled. Returns True if it called the function.
         '''
-        if message.author.bot:
+        if message.author.bot or not self.in_scope(message):
             return False
-        match = False
         if self.require_mention and not MessageResponder.mentions_bot(message):
             return False
-        if isinstance(self.condition, str):
-            if re.search(self.condition, message.content, re.IGNORECASE):
-                match = True
-        elif isinstance(self.condition, list):
-            for regex in self.condition:
-                if re.search(regex, message.content, re.IGNORECASE):
-                    match = True
-                    break
-        elif inspect.isfunction(self.condition) and self.condition(message):
-            match = True
+        match = self.condition_met(message)
         if match:
-            if inspect.iscoroutinefunction(self.responder):
-                asyncio.create_task(self.responder(message))
-            else:
-                potential_future = self.responder(message)
-                if potential_future is not None:
-                    asyncio.create_task(potential_future)
+            self.respond(message)
         return match
 
 
+class TriggerMatcher():
+    '''
+    Holds a group of MessageResponders and finds every one of them that a message
+    triggers. The regular expression conditions of all of the responders are
+    combined into a single compiled pattern when responders are added, so a
+    message's content is scanned once no matter how many patterns (or words in a
+    word list) there are; function conditions are still called one by one.
+    '''
+
+    def __init__(self):
+        self.responders: list[MessageResponder] = []
+        # built lazily the first time a message is matched after responders change
+        self._combined: Optional[re.Pattern] = None
+        # maps the index of each responder's named group in the combined pattern to
+        # that responder's position in self.responders
+        self._group_to_responder: dict[int, int] = {}
+
+    def add(self, responder: MessageResponder):
+        self.responders.append(responder)
+        if responder.pattern is not None:
+            self._combined = None
+
+    def __len__(self):
+        return len(self.responders)
+
+    def _compile(self):
+        alternatives = [
+            f"(?P<_responder{i}>{responder.pattern})"
+            for i, responder in enumerate(self.responders)
+            if responder.pattern is not None
+        ]
+        # each alternative is wrapped in a lookahead so that matches don't consume
+        # any text; otherwise a long match like "make .* fight" could swallow the
+        # text that another responder was looking for
+        self._combined = re.compile(
+            "(?=" + "|".join(alternatives) + ")" if alternatives else "(?!)",
+            re.IGNORECASE
+        )
+        self._group_to_responder = {
+            index: int(name[len("_responder"):])
+            for name, index in self._combined.groupindex.items()
+            if name.startswith("_responder")
+        }
+
+    def _pattern_matches(self, content: str) -> set[int]:
+        '''
+        Returns the indices of the responders whose regular expression conditions
+        are found in the content.
+        '''
+        if self._combined is None:
+            self._compile()
+        fired: set[int] = set()
+        hit_positions: list[int] = []
+        for match in self._combined.finditer(content):
+            # the last group to close is the outer named group of the responder
+            # whose pattern matched here
+            fired.add(self._group_to_responder[match.lastindex])
+            hit_positions.append(match.start())
+        if hit_positions:
+            # at each position, only the first alternative that matches is
+            # reported, so check whether any of the other responders would have
+            # matched at the same spots too
+            for i, responder in enumerate(self.responders):
+                if i in fired or responder.compiled_pattern is None:
+                    continue
+                if any(responder.compiled_pattern.match(content, position)
+                       for position in hit_positions):
+                    fired.add(i)
+        return fired
+
+    def match(self, message: discord.Message) -> list[MessageResponder]:
+        '''
+        Returns every responder whose condition the message meets, in the order in
+        which they were added.
+        '''
+        if message.author.bot or not self.responders:
+            return []
+        pattern_matches = self._pattern_matches(message.content)
+        mentioned: Optional[bool] = None
+        result = []
+        for i, responder in enumerate(self.responders):
+            if responder.pattern is not None:
+                if i not in pattern_matches:
+                    continue
+            elif responder.condition is not None and not (
+                    inspect.isfunction(responder.condition)
+                    and responder.condition(message)):
+                continue
+            if responder.require_mention:
+                if mentioned is None:
+                    mentioned = MessageResponder.mentions_bot(message)
+                if not mentioned:
+                    continue
+            result.append(responder)
+        return result
+
+
+class ResponderIndex():
+    '''
+    Sorts MessageResponders by their channel and guild scopes so that each message
+    is only checked against the responders for its own channel (or thread, or
+    thread's parent channel), its own guild, and the ones that apply everywhere.
+    '''
+
+    def __init__(self):
+        self.global_responders = TriggerMatcher()
+        self.by_channel: dict[int, TriggerMatcher] = {}
+        self.by_thread_parent: dict[int, TriggerMatcher] = {}
+        self.by_guild: dict[int, TriggerMatcher] = {}
+        # registration order, so that responders from different scopes still
+        # respond in the order they were added
+        self._order: dict[MessageResponder, int] = {}
+
+    def add(self, responder: MessageResponder):
+        self._order[responder] = len(self._order)
+        if responder.channel_id is not None:
+            self.by_channel.setdefault(responder.channel_id, TriggerMatcher()).add(responder)
+            if responder.include_threads:
+                self.by_thread_parent.setdefault(
+                    responder.channel_id, TriggerMatcher()
+                ).add(responder)
+        elif responder.guild_id is not None:
+            self.by_guild.setdefault(responder.guild_id, TriggerMatcher()).add(responder)
+        else:
+            self.global_responders.add(responder)
+
+    def __len__(self):
+        return len(self._order)
+
+    def matchers_for(self, message: discord.Message) -> list[TriggerMatcher]:
+        matchers = [self.global_responders]
+        if message.channel.id in self.by_channel:
+            matchers.append(self.by_channel[message.channel.id])
+        parent_id = getattr(message.channel, "parent_id", None)
+        if parent_id in self.by_thread_parent:
+            matchers.append(self.by_thread_parent[parent_id])
+        if message.guild is not None and message.guild.id in self.by_guild:
+            matchers.append(self.by_guild[message.guild.id])
+        return matchers
+
+    def match(self, message: discord.Message) -> list[MessageResponder]:
+        '''
+        Returns every responder in scope whose condition the message meets, in the
+        order in which they were added.
+        '''
+        matchers = self.matchers_for(message)
+        if len(matchers) == 1:
+            return matchers[0].match(message)
+        result = []
+        for matcher in matchers:
+            for responder in matcher.match(message):
+                # channel-scoped responders can also be limited to a guild
+                if responder.guild_id is None or responder.in_scope(message):
+                    result.append(responder)
+        return sorted(result, key=self._order.__getitem__)
+
+
 def add_responses(bot: MitchBot):
+    assets.hot_reload = bot.test_mode
+    assets.preload()
+
     bot.register_responder(
         MessageResponder(
             [r"\bbot\b", "mitchbot", "robot"],
@@ -126,18 +353,14 @@ def add_responses(bot: MitchBot):
     # )
 
     async def _fight(fighters: list[discord.User]) -> BytesIO:
-        i1 = await bot.get_avatar_small(fighters[0], 180)
-        i2 = await bot.get_avatar_small(fighters[1], 180)
-        bg = Image.open('images/fight.png')
-        blank = Image.new("RGBA", (640, 200), 0)
-        mask = Image.open('images/mask.png')
-        blank.paste(i1, (10, 10))
-        blank.paste(i2, (640-10-180, 10))
-        bg.paste(blank, (0, 0), mask)
-        image_bytes = BytesIO()
-        bg.save(image_bytes, format='PNG')
-        image_bytes.seek(0)
-        return image_bytes
+        async def render():
+            i1 = await bot.get_avatar_small(fighters[0], 180)
+            i2 = await bot.get_avatar_small(fighters[1], 180)
+            return await render_pool.run(render_fight, i1, i2)
+        return BytesIO(await render_cache.get_or_render(
+            "fight", fighters, render,
+            assets.version("fight"), assets.version("fight_mask")
+        ))
     
     def _fight_alt_text(fighters: list[discord.User]) -> str:
         return f"{fighters[0].name} and {fighters[1].name} with crossed swords between them"
@@ -159,7 +382,15 @@ def add_responses(bot: MitchBot):
                     )
                 )
 
-    bot.register_responder(MessageResponder(r"\bmake\b.*\bfight\b", message_fight))
+    bot.register_responder(
+        MessageResponder(
+            r"\bmake\b.*\bfight\b",
+            message_fight,
+            max_concurrency=2,
+            overload=OverloadPolicy.coalesce,
+            busy_reply="too many fights going on rn, try again in a sec"
+        )
+    )
 
     @bot.slash_command(description="Self explanatory")
     async def start_fight(
@@ -175,16 +406,13 @@ def add_responses(bot: MitchBot):
         )
 
     async def _kiss(recipient: discord.User):
-        avatar = await bot.get_avatar_small(recipient, 200)
-        blank = Image.new('RGBA', (200, 200), 0)
-        mask = Image.open("images/mask_rect.png")
-        blank.paste(avatar, (0, 0), mask)
-        smooch = Image.open("images/kiss.png")
-        final = Image.alpha_composite(blank, smooch)
-        image_bytes = BytesIO()
-        final.save(image_bytes, format='PNG')
-        image_bytes.seek(0)
-        return image_bytes
+        async def render():
+            avatar = await bot.get_avatar_small(recipient, 200)
+            return await render_pool.run(render_kiss, avatar)
+        return BytesIO(await render_cache.get_or_render(
+            "kiss", [recipient], render,
+            assets.version("kiss"), assets.version("kiss_mask")
+        ))
     
     def _kiss_alt_text(recipient: discord.User) -> str:
         return f"{recipient.name}'s avatar with lipstick marks on it"
@@ -198,7 +426,16 @@ def add_responses(bot: MitchBot):
                     description=_kiss_alt_text(message.author)
                 )
             )
-    bot.register_responder(MessageResponder("kiss", message_kiss, require_mention=True))
+    bot.register_responder(
+        MessageResponder(
+            "kiss",
+            message_kiss,
+            require_mention=True,
+            max_concurrency=2,
+            overload=OverloadPolicy.coalesce,
+            busy_reply="too many kisses to give out rn, try again in a sec"
+        )
+    )
 
     @bot.slash_command(description="kis 🥺")
     async def kiss(ctx: ApplicationCommandInteraction):
@@ -225,11 +462,11 @@ def add_responses(bot: MitchBot):
     # bot.register_responder(MessageResponder(r"\bwhat\b.*\bday\b|\bday of the week\b", day_of_week))
 
     def nicknames_by_count(count: int):
-        nicknames = [get_random_nickname() for _ in range(0, count)]
+        chosen = nicknames.sample(count)
         return (
             "Hello, " + (
-                ", ".join(nicknames[:-1])+", and/or " if count > 1 else ""
-            )+nicknames[-1]+".")
+                ", ".join(chosen[:-1])+", and/or " if count > 1 else ""
+            )+chosen[-1]+".")
 
     async def nickname(message: discord.Message):
         if "nicknames" in message.content.lower():
@@ -255,22 +492,11 @@ def add_responses(bot: MitchBot):
     ):
       await ctx.response.send_message(nicknames_by_count(count), ephemeral=True)
 
-    async def _process_emoji(emoji_image: discord.Attachment):
-        emoji_file = BytesIO()
-        await emoji_image.save(emoji_file, seek_begin=True)
-        # resize image so that the largest dimension is 128 pixels to help with
-        # file size
-        emoji_image = Image.open(emoji_file, formats=["jpeg", "png", "gif"])
-        largest_dimension = max(emoji_image.width, emoji_image.height)
-        scale_factor = 128/largest_dimension
-        emoji_image = emoji_image.resize(
-            (round(emoji_image.width * scale_factor), round(emoji_image.height * scale_factor)),
-            resample=Image.LANCZOS)
-        resized_file = BytesIO()
-        emoji_image.save(resized_file, format="png")
-        resized_file.seek(0)
-        resized_file = resized_file.read()
-        return resized_file
+    async def _process_emoji(emoji_image: discord.Attachment) -> bytes:
+        # raises EmojiImageError without downloading anything if discord's metadata
+        # for the attachment already tells us that it's not going to work
+        check_emoji_source(emoji_image.size, emoji_image.width, emoji_image.height)
+        return await render_pool.run(prepare_emoji, await emoji_image.read())
     
     async def add_emoji_message(message: discord.Message):
         emoji_name_match = re.search("make (.*) emoji", message.content)
@@ -278,7 +504,11 @@ def add_responses(bot: MitchBot):
             len(emoji_name_match.group(1).strip()) and
                 len(message.attachments) > 0):
             emoji_name = emoji_name_match.group(1).strip().strip('"\'')
-            emoji_file = await _process_emoji(message.attachments[0])
+            try:
+                emoji_file = await _process_emoji(message.attachments[0])
+            except EmojiImageError as e:
+                await message.channel.send(f"I couldn't :( {e}")
+                return
             try:
                 created_emoji = await message.guild.create_custom_emoji(name=emoji_name, image=emoji_file)
                 await message.channel.send("Done "+str(created_emoji))
@@ -299,7 +529,8 @@ def add_responses(bot: MitchBot):
         MessageResponder(
             "make .* emoji",
             add_emoji_message,
-            require_mention=True
+            require_mention=True,
+            max_concurrency=1
         )
     )
 
@@ -309,12 +540,16 @@ def add_responses(bot: MitchBot):
         file: discord.Attachment,
         name: str,
     ):
-        emoji_file = await _process_emoji(file)
         if not (2 <= len(name) <= 32):
             await ctx.response.send_message(
                 "emoji names must be between 2 and 32 characters long",
                 ephemeral=True
             )
+            return
+        try:
+            emoji_file = await _process_emoji(file)
+        except EmojiImageError as e:
+            await ctx.response.send_message(f"I couldn't :( {e}", ephemeral=True)
         else:
             try:
                 created_emoji = await ctx.guild.create_custom_emoji(
@@ -330,11 +565,7 @@ def add_responses(bot: MitchBot):
                 )
 
 
-    with open("text/untamed.txt") as untamed_words_file:
-        untamed_word_list = untamed_words_file.read()
-        untamed_words = [
-            r"\b"+x.strip('"')+r"\b"
-            for x in re.findall(r"(?:\"[^\"]+?\")|(?:\b(?:\w|-)+?\b)", untamed_word_list)]
+    untamed_words = [r"\b"+x+r"\b" for x in corpora["untamed"].records]
 
     async def react_negatively(message: discord.Message):
         today = datetime.date.today()
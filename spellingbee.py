@@ -1,10 +1,15 @@
 from __future__ import annotations
 import asyncio
+import atexit
+import copy
+import threading
 from io import BytesIO
-from typing import TYPE_CHECKING
+from typing import Optional, TYPE_CHECKING
 import traceback
 from datetime import datetime, time, timedelta
 import random
+from math import inf
+from timeit import default_timer
 from urllib.error import HTTPError
 from zoneinfo import ZoneInfo
 
@@ -14,6 +19,9 @@ from PIL import Image
 from bee_engine import SpellingBee, SessionBee, BeeRenderer
 
 from responders import MessageResponder
+from reactions import reaction_scheduler
+from db.database import get_database
+from rendering import PuzzleRenderPipeline
 from grammar import andify
 from scheduler import repeatedly_schedule_task_for
 if TYPE_CHECKING:
@@ -21,14 +29,231 @@ if TYPE_CHECKING:
     from disnake.interactions import ApplicationCommandInteraction
     
 db_path = "./db/bee_engine.db"
+# bee_engine opens its own connections, but WAL mode is stored in the database file,
+# so switching it on here lets them read while another one is writing
+get_database(db_path)
+render_pipeline = PuzzleRenderPipeline("db/bee_renders")
+
+
+class PrimarySession:
+    """
+    Keeps the primary SessionBee in memory for the whole puzzle day instead of
+    loading it from the database for every message. It is loaded the first time
+    it's needed and replaced when a new puzzle is posted. Changes are written back
+    on a worker thread flush_delay seconds after the first change since the last
+    write (so a burst of guesses becomes one write), and right away when the
+    session is replaced and at shutdown. The formatted hints are also kept until the
+    words that have been found change.
+    """
+
+    def __init__(self, db_path: str, flush_delay: float = 5.0):
+        self.db_path = db_path
+        self.flush_delay = flush_delay
+        self.session: Optional[SessionBee] = None
+        self.loaded = False
+        self.dirty = False
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        # keeps a flush on the worker thread and one at exit from overlapping
+        self.persist_lock = threading.Lock()
+        self.flushes = 0
+        # goes up every time the session or its found words change
+        self.version = 0
+        self.hints: Optional[tuple[int, str]] = None
+        self.hint_cache_hits = 0
+        atexit.register(self.flush)
+
+    def get(self) -> Optional[SessionBee]:
+        if not self.loaded:
+            self.session = SessionBee.retrieve_saved("primary", self.db_path)
+            self.loaded = True
+        return self.session
+
+    def replace(self, session: SessionBee):
+        """Makes session the primary session. It should already have been saved."""
+        self.flush()
+        self.session = session
+        self.loaded = True
+        self.version += 1
+
+    def mark_changed(self):
+        self.version += 1
+        self.dirty = True
+        if self.flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self.flush_handle = loop.call_later(self.flush_delay, self._flush_later)
+
+    def _flush_later(self):
+        self.flush_handle = None
+        self.flush_task = asyncio.create_task(self.flush_in_thread())
+
+    def get_hints(self) -> str:
+        """Returns the hints for the words that haven't been found yet, formatted for
+        discord."""
+        if self.hints is not None and self.hints[0] == self.version:
+            self.hint_cache_hits += 1
+            return self.hints[1]
+        version = self.version
+        hints = self.get().get_unguessed_hints().format_all_for_discord()
+        self.hints = (version, hints)
+        return hints
+
+    def flush(self):
+        """Writes the session out now, on the calling thread."""
+        session = self._start_flush()
+        if session is not None:
+            self._persist(session)
+
+    async def flush_in_thread(self):
+        """Like flush, but the write happens on a worker thread so that it doesn't
+        hold up the event loop."""
+        session = self._start_flush()
+        if session is not None:
+            # guesses keep changing the live session while the write is going on
+            await asyncio.to_thread(self._persist, self._snapshot(session))
+
+    @staticmethod
+    def _snapshot(session: SessionBee) -> SessionBee:
+        """Returns a copy of session that shares nothing that can change (like
+        gotten_words) with it; made on the event loop, so it's consistent."""
+        snapshot = copy.copy(session)
+        for name, value in vars(session).items():
+            if isinstance(value, (set, list, dict)):
+                setattr(snapshot, name, copy.copy(value))
+        return snapshot
+
+    def _start_flush(self) -> Optional[SessionBee]:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.dirty or self.session is None:
+            return None
+        self.dirty = False
+        return self.session
+
+    def _persist(self, session: SessionBee):
+        try:
+            with self.persist_lock:
+                session.persist_to(self.db_path)
+            self.flushes += 1
+        except:
+            self.dirty = True
+            print("could not save spelling bee session !!!")
+            traceback.print_exc()
+
+
+primary_session = PrimarySession(db_path)
+
+
+class StatusUpdater:
+    """
+    Edits the message that lists the words found so far. The message object is kept
+    instead of being fetched for every edit, and edits are made at most once every
+    interval seconds: the first change after a quiet spell goes out right away, and
+    any changes made during the wait are merged into one edit with the latest text
+    once it is over, so the last state always ends up in the message. An edit that
+    fails is tried again (unless newer text has come in by then) after a delay that
+    doubles with each failure, up to max_retries times.
+    """
+
+    def __init__(self, interval: float = 3.0, max_retries: int = 5):
+        self.interval = interval
+        self.max_retries = max_retries
+        # extra time to wait before the next edit because the last one failed
+        self.backoff = 0.0
+        self.retries = 0
+        self.message: Optional[discord.Message | discord.PartialMessage] = None
+        self.pending: Optional[tuple[discord.abc.Messageable, int, str]] = None
+        self.last_text: Optional[str] = None
+        self.last_edit_at = -inf
+        self.task: Optional[asyncio.Task] = None
+        self.edits = 0
+        # updates that were replaced by a newer one before they could be made
+        self.coalesced = 0
+        # updates that weren't made because the message already said the same thing
+        self.skipped = 0
+        self.failed = 0
+
+    def update(self, channel: discord.abc.Messageable, message_id: int, text: str):
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = (channel, message_id, text)
+        if self.task is None:
+            self.task = asyncio.create_task(self._work())
+
+    async def _get_message(
+            self,
+            channel: discord.abc.Messageable,
+            message_id: int) -> discord.Message | discord.PartialMessage:
+        if self.message is None or self.message.id != message_id:
+            self.last_text = None
+            if hasattr(channel, "get_partial_message"):
+                # enough to edit the message with, without a fetch
+                self.message = channel.get_partial_message(message_id)
+            else:
+                self.message = await channel.fetch_message(message_id)
+        return self.message
+
+    async def _work(self):
+        try:
+            while self.pending is not None:
+                wait = self.last_edit_at + self.interval + self.backoff - default_timer()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                channel, message_id, text = self.pending
+                self.pending = None
+                try:
+                    message = await self._get_message(channel, message_id)
+                    if text == self.last_text:
+                        self.skipped += 1
+                        continue
+                    self.message = await message.edit(content=text) or message
+                    self.last_text = text
+                    self.edits += 1
+                    self.backoff = 0.0
+                    self.retries = 0
+                except Exception:
+                    self.failed += 1
+                    self.message = None
+                    print("could not update puzzle status message !!!")
+                    traceback.print_exc()
+                    if self.pending is not None:
+                        # newer text came in while the edit was being made
+                        self.backoff = 0.0
+                        self.retries = 0
+                    elif self.retries < self.max_retries:
+                        self.pending = (channel, message_id, text)
+                        self.backoff = self.backoff * 2 if self.backoff else self.interval
+                        self.retries += 1
+                    else:
+                        print("giving up on that update")
+                        self.backoff = 0.0
+                        self.retries = 0
+                self.last_edit_at = default_timer()
+        finally:
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "edits": self.edits,
+            "coalesced": self.coalesced,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+
+status_updater = StatusUpdater()
 
 async def fetch_new_puzzle(quick_render=False):
     print("fetching puzzle from NYT...")
     todays_puzzle = await SpellingBee.fetch_from_nyt()
     print("fetched. rendering graphic...")
-    await todays_puzzle.render(
-        "hexspin" if quick_render else ""
-    )
+    await render_pipeline.render(todays_puzzle, "hexspin" if quick_render else "")
     print("graphic rendered. saving today's puzzle in database")
     todays_puzzle.persist_to(db_path)
 
@@ -50,7 +275,7 @@ async def post_new_puzzle(channel: discord.TextChannel):
         message_text += (
             " Words from Wiktionary that should count today that the NYT "
             f"fails to acknowledge include: {andify(alt_words_sample)}.")
-    yesterdays_puzzle = SessionBee.retrieve_saved("primary", db_path)
+    yesterdays_puzzle = primary_session.get()
     if yesterdays_puzzle is not None:
         previous_words = yesterdays_puzzle.get_unguessed_words()
         if len(previous_words) > 1:
@@ -82,43 +307,39 @@ async def post_new_puzzle(channel: discord.TextChannel):
     )
     session.persist_to(db_path)
     session.make_primary_session()
+    primary_session.replace(session)
 
 
 async def respond_to_guesses(message: discord.Message):
-    current_puzzle = SessionBee.retrieve_saved("primary", db_path)
+    current_puzzle = primary_session.get()
     if current_puzzle is None:
         return
-    current_puzzle.persist_to(db_path)
     already_found = len(current_puzzle.gotten_words)
     reactions = current_puzzle.respond_to_guesses(message.content)
-    for reaction in reactions:
-        await message.add_reaction(reaction)
+    if len(current_puzzle.gotten_words) != already_found:
+        primary_session.mark_changed()
+    reaction_scheduler.set_reactions(message, reactions)
     if len(current_puzzle.gotten_words) == already_found:
         return
-    try:
-        puzzle_channel = message.channel
-        status_message: discord.Message = (
-            await puzzle_channel.fetch_message(
-                current_puzzle.metadata["status_message_id"]
-            )
-        )
-        status_text = 'Words found by you guys so far: '
-        status_text += current_puzzle.list_gotten_words(separate_pangrams=True, enclose_with=["||", "||"])
-        status_text += f' ({round(current_puzzle.percentage_words_gotten(), 1)}% complete'
-        if current_puzzle.percentage_words_gotten() == 100:
-            status_text += " 🎉)"
-        else:
-            status_text += ")"
-        await status_message.edit(content=status_text)
+    status_updater.update(
+        message.channel, current_puzzle.metadata["status_message_id"],
+        get_status_text(current_puzzle))
 
-    except:
-        print("could not retrieve Discord message and update puzzle status !!!")
-        traceback.print_exc()
+
+def get_status_text(session: SessionBee) -> str:
+    status_text = 'Words found by you guys so far: '
+    status_text += session.list_gotten_words(separate_pangrams=True, enclose_with=["||", "||"])
+    status_text += f' ({round(session.percentage_words_gotten(), 1)}% complete'
+    if session.percentage_words_gotten() == 100:
+        status_text += " 🎉)"
+    else:
+        status_text += ")"
+    return status_text
 
 
 def add_bee_functionality(bot: MitchBot):
     try:
-        current_puzzle = SessionBee.retrieve_saved("primary", db_path)
+        current_puzzle = primary_session.get()
         assert current_puzzle is not None
     except:
         print("could not retrieve last puzzle from database; " +
@@ -145,7 +366,7 @@ def add_bee_functionality(bot: MitchBot):
         post_new_puzzle_at, lambda: post_new_puzzle(puzzle_channel), "post_new_puzzle"))
 
     bot.register_responder(MessageResponder(
-        lambda m: m.channel.id == puzzle_channel_id, respond_to_guesses))
+        None, respond_to_guesses, channel_id=puzzle_channel_id, max_concurrency=1))
 
     @bot.event
     async def on_message_edit(before: discord.Message, after: discord.Message):
@@ -153,20 +374,11 @@ def add_bee_functionality(bot: MitchBot):
             return
         if after.channel.id == puzzle_channel_id:
             if before.content != after.content:
-                # remove old reactions
-                for reaction in after.reactions:
-                    if reaction.me:
-                        await reaction.remove(bot.user)
-                # replace with new ones
+                # the reaction scheduler replaces the old reactions with the new ones
                 await respond_to_guesses(after)
 
     async def obtain_hint(ctx: ApplicationCommandInteraction):
-        await ctx.response.send_message(
-            SessionBee
-                .retrieve_saved("primary", db_path)
-                .get_unguessed_hints()
-                .format_all_for_discord()
-        )
+        await ctx.response.send_message(primary_session.get_hints())
 
     bot.register_hint(puzzle_channel_id, obtain_hint)
 